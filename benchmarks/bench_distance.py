@@ -0,0 +1,74 @@
+#  Benchmark of the distance computation of bodegha.py
+#
+#  Compares the pairwise computation of distances with the vectorized one of compute_distance,
+#  and checks that both give identical values once rounded to the float32 values of its
+#  condensed distance vector.
+#
+#  Usage: python benchmarks/bench_distance.py [--sizes 100 500 1000] [--repeat 3]
+
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+
+
+WORDS = (
+    'the a fix bug issue please thanks merge review looks good to me lgtm change code test '
+    'add remove build passed failed coverage increased decreased remains same at see logs'
+).split()
+
+
+def generate_comments(n, seed=0):
+    rnd = random.Random(seed)
+    return [
+        ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(0, 60)))
+        for _ in range(n)
+    ]
+
+
+def pairwise(items, distance):
+    return np.asarray([
+        distance(items[i], items[j])
+        for i in range(len(items)) for j in range(i + 1, len(items))])
+
+
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of distance computation')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[100, 500, 1000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>6} {:>16} {:>12} {:>12} {:>8}'.format(
+        'n', 'distance', 'pairwise (s)', 'vector (s)', 'speedup'))
+    for n in args.sizes:
+        items = generate_comments(n)
+        for distance in [bodegha.jaccard, bodegha.average_jac_lev]:
+            before, expected = measure(lambda: pairwise(items, distance), args.repeat)
+            after, result = measure(
+                lambda: bodegha.compute_distance(items, distance), args.repeat)
+            if not np.array_equal(expected.astype(np.float32), result):
+                sys.exit('compute_distance differs from {} for n={}'.format(
+                    distance.__name__, n))
+            print('{:>6} {:>16} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(
+                n, distance.__name__, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
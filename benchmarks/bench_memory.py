@@ -0,0 +1,117 @@
+#  Memory benchmark of the feature computation of bodegha.py
+#
+#  Computes the patterns and dispersion features of a single account with n distinct
+#  comments, each time in a new process, and reports its peak resident memory (RSS) and the
+#  part of it used by the computation itself. The features are computed by account_features,
+#  whose distances are a condensed float32 vector computed by blocks of rows, and by the
+#  previous pipeline, reproduced here, whose distances were dense float64 matrices. Both
+#  must find the same patterns and the same dispersion, up to the float32 rounding of the
+#  distances.
+#
+#  Usage: python benchmarks/bench_memory.py [--sizes 500 1000 2000]
+
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bodegha  # noqa: E402
+from bench_distance import generate_comments  # noqa: E402
+
+
+def dense_features(bodies, counts, params):
+    """
+    The features of account_features, computed from dense float64 distance matrices.
+    """
+    from Levenshtein import distance as lev
+    from scipy.sparse.csgraph import connected_components
+    n = len(bodies)
+    terms, sizes = bodegha.term_matrix(bodies)
+    intersection = (terms @ terms.T).toarray()
+    union = sizes[:, np.newaxis] + sizes[np.newaxis, :] - intersection
+    jaccard = (union - intersection) / np.where(union > 0, union, 1)
+    levenshtein = np.zeros((n, n))
+    for i, j in itertools.combinations(range(n), 2):
+        longest = max(len(bodies[i]), len(bodies[j]))
+        levenshtein[i, j] = levenshtein[j, i] = lev(bodies[i], bodies[j]) / (longest or 1)
+    items = (jaccard + levenshtein) / 2
+    patterns, _ = connected_components(items <= params['eps'], directed=False)
+    rows, columns = np.triu_indices(n, 1)
+    distances = items[rows, columns]
+    nonzero = distances != 0
+    return patterns, bodegha.gini(distances[nonzero], (counts[rows] * counts[columns])[nonzero])
+
+
+def max_rss():
+    """
+    Returns the peak resident memory of the process, in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def child(mode, n):
+    bodies, counts = bodegha.unique_items(generate_comments(n))
+    while len(bodies) < n:
+        bodies, counts = bodegha.unique_items(generate_comments(2 * n - len(bodies)))
+    bodies, counts = bodies[:n], counts[:n]
+    function = bodegha.account_features if mode == 'condensed' else dense_features
+    before = max_rss()
+    start = time.perf_counter()
+    features = function(bodies, counts, bodegha.FEATURE_PARAMS)
+    if mode == 'condensed':
+        features = features[0]
+    print(json.dumps({
+        'time': time.perf_counter() - start,
+        'peak': max_rss(),
+        'features': max_rss() - before,
+        'patterns': int(features[0]),
+        'dispersion': float(features[1]),
+    }))
+
+
+def measure(mode, n):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', mode, str(n)],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory benchmark of the feature computation')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[500, 1000, 2000])
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'N'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        child(args.child[0], int(args.child[1]))
+        return
+
+    print('{:>6} {:>10} {:>10} {:>12} {:>15}'.format(
+        'n', 'distances', 'time (s)', 'peak (MiB)', 'features (MiB)'))
+    for n in args.sizes:
+        results = {mode: measure(mode, n) for mode in ('dense', 'condensed')}
+        for mode, result in results.items():
+            print('{:>6} {:>10} {:>10.3f} {:>12.1f} {:>15.1f}'.format(
+                n, mode, result['time'], result['peak'] / 2**20, result['features'] / 2**20))
+        dense, condensed = results['dense'], results['condensed']
+        if dense['patterns'] != condensed['patterns'] or \
+                abs(dense['dispersion'] - condensed['dispersion']) > 1e-6:
+            sys.exit('The features differ for n={}: {} (dense), {} (condensed)'.format(
+                n, (dense['patterns'], dense['dispersion']),
+                (condensed['patterns'], condensed['dispersion'])))
+        print('{:>6} {:>10} {:>10} {:>12.1%} {:>15.1%}'.format(
+            '', 'ratio', '', condensed['peak'] / dense['peak'],
+            condensed['features'] / max(dense['features'], 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#  Accuracy report of the approximate pattern detection of bodegha.py
+#
+#  Computes the features of the accounts of a synthetic repository (or of GraphQL responses
+#  recorded with bench_pipeline.py --record) with the exact engine and with the lsh engine
+#  (--patterns-engine lsh), and reports, for each engine, the time spent computing features,
+#  and for the lsh engine, the errors of its patterns and dispersion features and the
+#  accounts whose prediction differs from the one of the exact engine.
+#
+#  The lsh engine only approximates the features of accounts having more than
+#  LSH_MIN_COMMENTS distinct comments, so --max-comments should be larger than it for the
+#  engines to differ. The report fails if fewer predictions than
+#  --min-agreement agree with the exact ones.
+#
+#  Usage: python benchmarks/bench_patterns.py [--authors 20] [--comments 1000]
+#                                            [--max-comments 1000] [--min-agreement 0.95]
+#         python benchmarks/bench_patterns.py --fixture FILE --repository owner/repo
+
+
+import argparse
+import os
+import sys
+import time
+import warnings
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_pipeline  # noqa: E402
+from bench_pipeline import bodegha  # noqa: E402
+
+
+def run_engines(comments, min_comments, max_comments):
+    """
+    Returns the features and predictions of the accounts with each engine, by engine, and the
+    time spent computing the features.
+    """
+    df = bodegha.select_comments(comments, [], [], min_comments, max_comments)
+    model = bodegha.get_model()
+    results = {}
+    for engine in bodegha.FEATURE_ENGINES:
+        start = time.perf_counter()
+        features = bodegha.compute_features(df, max_comments, engine=engine)
+        elapsed = time.perf_counter() - start
+        results[engine] = (
+            bodegha.predict(model, features).set_index('account').sort_index(), elapsed)
+    return results
+
+
+def report(results, verbose):
+    """
+    Prints the accuracy of the lsh engine with respect to the exact one and returns the
+    fraction of predictions that agree.
+    """
+    exact, exact_time = results['exact']
+    lsh, lsh_time = results['lsh']
+    patterns_error = (lsh['patterns'] - exact['patterns']).abs() / exact['patterns']
+    dispersion_error = (lsh['dispersion'] - exact['dispersion']).abs()
+    differs = lsh['prediction'] != exact['prediction']
+
+    if verbose:
+        table = exact[['comments', 'patterns', 'dispersion', 'prediction']].join(
+            lsh[['patterns', 'dispersion', 'prediction']], rsuffix=' (lsh)')
+        print(table.to_string())
+        print()
+    print('{:>10} {:>14} {:>10}'.format('engine', 'features (s)', 'speedup'))
+    print('{:>10} {:>14.3f} {:>10}'.format('exact', exact_time, ''))
+    print('{:>10} {:>14.3f} {:>10.2f}'.format('lsh', lsh_time, exact_time / lsh_time))
+    print()
+    print('accounts: {}'.format(len(exact)))
+    print('patterns relative error: mean {:.2%}, max {:.2%}'.format(
+        patterns_error.mean(), patterns_error.max()))
+    print('dispersion absolute error: mean {:.5f}, max {:.5f}'.format(
+        dispersion_error.mean(), dispersion_error.max()))
+    print('predictions agreeing: {} of {} ({:.1%})'.format(
+        len(exact) - differs.sum(), len(exact), 1 - differs.mean()))
+    for account in exact.index[differs]:
+        print('  {}: {} (exact) -> {} (lsh)'.format(
+            account, exact.at[account, 'prediction'], lsh.at[account, 'prediction']))
+    return 1 - differs.mean()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Accuracy of the approximate pattern detection of bodegha')
+    parser.add_argument('--authors', type=int, default=20)
+    parser.add_argument('--comments', type=int, default=1000, help='Comments per author')
+    parser.add_argument('--body-length', type=int, default=20, help='Mean words per body')
+    parser.add_argument('--bot-ratio', type=float, default=0.25)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-comments', type=int, default=10)
+    parser.add_argument('--max-comments', type=int, default=1000)
+    parser.add_argument('--repository', type=str, default='synthetic/repository')
+    parser.add_argument('--start-date', type=str, default=None)
+    parser.add_argument('--fixture', metavar='FILE', type=str, default=None,
+                        help='Use the responses recorded in FILE')
+    parser.add_argument('--min-agreement', type=float, default=0.95,
+                        help='Fail if a smaller fraction of predictions agree (default=0.95)')
+    parser.add_argument('--verbose', action='store_true', help='Print the features of each account')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore')
+
+    if args.start_date is not None:
+        import dateutil.parser
+        date = dateutil.parser.parse(args.start_date)
+    else:
+        date = bench_pipeline.START - timedelta(days=1)
+
+    if args.fixture is not None:
+        fixture = bench_pipeline.load_fixture(args.fixture)
+    else:
+        items = bench_pipeline.generate_repository(
+            args.authors, args.comments, args.body_length, args.bot_ratio, args.seed)
+        fixture = bench_pipeline.synthetic_fixture(args.repository, items)
+    bench_pipeline.replay(fixture)
+    comments = bodegha.process_comments(
+        args.repository, [], date, args.min_comments, args.max_comments, 'fixture')
+
+    agreement = report(run_engines(comments, args.min_comments, args.max_comments), args.verbose)
+    if agreement < args.min_agreement:
+        sys.exit('Only {:.1%} of the predictions agree with the exact engine'.format(agreement))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+#  Benchmark of the stages of bodegha.py, without the GitHub API
+#
+#  Runs the download, extract, distance, features and predict stages on a synthetic
+#  repository (or on GraphQL responses recorded from a real one), and reports for each stage
+#  its wall time, its peak memory (as traced by tracemalloc) and its throughput in comments
+#  and accounts per second.
+#
+#  GraphQL responses are replayed by a stand-in for graphql_request that looks them up by
+#  query, so that the download stage runs the same code as with the API. Responses of a real
+#  repository can be recorded once with --record (which requires --key) and replayed later
+#  with --fixture. A recorded fixture has to be recorded again when the queries change.
+#
+#  Results can be saved as a baseline with --save, and compared with a saved baseline with
+#  --compare: the benchmark fails if a stage is slower, or uses more memory, than allowed by
+#  --tolerance.
+#
+#  Usage: python benchmarks/bench_pipeline.py [--authors 100] [--comments 100]
+#                                            [--body-length 20] [--bot-ratio 0.1]
+#                                            [--repeat 3] [--save FILE] [--compare FILE]
+#         python benchmarks/bench_pipeline.py --fixture FILE --repository owner/repo
+#         python benchmarks/bench_pipeline.py --record FILE --repository owner/repo --key KEY
+
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+
+
+WORDS = (
+    'the a fix bug issue please thanks merge review looks good to me lgtm change code test '
+    'add remove build passed failed coverage increased decreased remains same at see logs'
+).split()
+
+TEMPLATES = [
+    'Build {} passed',
+    'Build {} failed, see the logs at https://ci.example.com/{}',
+    'Coverage remains the same at {}% when pulling {} into master',
+    'This issue has been automatically marked as stale ({} days without activity)',
+]
+
+START = datetime(2020, 1, 1)
+COMMENTS_PER_ITEM = 10
+
+
+# --- Synthetic repository ---
+def generate_repository(authors, comments, body_length, bot_ratio, seed=0):
+    """
+    Returns the pull requests and issues of a synthetic repository, in order of creation, in
+    which each of the given number of authors writes the given number of comments (including
+    the descriptions of the items they open). A bot_ratio fraction of the authors fill
+    templates, the others write random bodies of about body_length words.
+    """
+    rnd = random.Random(seed)
+    bots = int(round(authors * bot_ratio))
+    names = ['bot{}'.format(i) for i in range(bots)] + \
+        ['user{}'.format(i) for i in range(authors - bots)]
+
+    def body(author):
+        if author.startswith('bot'):
+            template = TEMPLATES[int(author[3:]) % len(TEMPLATES)]
+            return template.format(*(rnd.randint(1, 999) for _ in range(2)))
+        return ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 2 * body_length)))
+
+    writes = [name for name in names for _ in range(comments)]
+    rnd.shuffle(writes)
+    items = {'pullRequests': [], 'issues': []}
+    date = START
+    while writes:
+        issue_type = rnd.choice(list(items))
+        thread, writes = writes[:COMMENTS_PER_ITEM + 1], writes[COMMENTS_PER_ITEM + 1:]
+        date += timedelta(minutes=rnd.randint(1, 600))
+        number = sum(len(x) for x in items.values()) + 1
+        comment_dates = [date + timedelta(minutes=i + 1) for i in range(len(thread) - 1)]
+        items[issue_type].append({
+            'id': 'node{}'.format(number),
+            'author': {'login': thread[0]},
+            'body': body(thread[0]),
+            'number': number,
+            'createdAt': date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'updatedAt': (comment_dates[-1] if comment_dates else date).strftime(
+                '%Y-%m-%dT%H:%M:%SZ'),
+            'comments': [
+                {'author': {'login': author}, 'body': body(author),
+                 'createdAt': created.strftime('%Y-%m-%dT%H:%M:%SZ')}
+                for author, created in zip(thread[1:], comment_dates)],
+        })
+    return items
+
+
+def page_response(items, before):
+    """
+    Returns the GraphQL response body of the page of items (last:100) before a cursor, cursors
+    being positions in items.
+    """
+    end = len(items) if before is None else int(before)
+    start = max(end - 100, 0)
+    edges = []
+    for index in range(start, end):
+        node = dict(items[index])
+        comments = node['comments']
+        node['comments'] = {
+            'totalCount': len(comments),
+            'pageInfo': {'startCursor': None, 'endCursor': None},
+            'edges': [{'cursor': str(i), 'node': comment} for i, comment in enumerate(comments)],
+        }
+        edges.append({'cursor': str(index), 'node': node})
+    return {
+        'totalCount': len(items),
+        'pageInfo': {'startCursor': str(start), 'endCursor': str(end - 1)},
+        'edges': edges,
+    }
+
+
+def synthetic_fixture(repository, items):
+    """
+    Returns the responses, by query, of the pages bodegha requests to download all the
+    comments of the synthetic repository.
+    """
+    fixture = {}
+    for issue_type in ('pullRequests', 'issues'):
+        pr = issue_type == 'pullRequests'
+        before = None
+        while True:
+            query = bodegha.get_comment_search_query(
+                repository, pr, not pr, before if pr else None, None if pr else before)
+            page = page_response(items[issue_type], before)
+            fixture[query] = json.dumps({'data': {
+                'rateLimit': {'cost': 1, 'remaining': 5000, 'resetAt': '2030-01-01T00:00:00Z'},
+                'repository': {'createdAt': START.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                               issue_type: page},
+            }}).encode('utf-8')
+            if page['pageInfo']['startCursor'] == '0' or len(page['edges']) == 0:
+                break
+            before = page['pageInfo']['startCursor']
+    return fixture
+
+
+# --- Recorded fixtures ---
+def record(path, repository, apikey, date):
+    """
+    Downloads the comments of a repository from the API and writes every query and its
+    response to path, as json lines.
+    """
+    graphql_request = bodegha.graphql_request
+    lock = threading.Lock()
+    with open(path, 'w') as file:
+        def recording(query, apikey, limiter=None):
+            response = graphql_request(query, apikey, limiter)
+            line = json.dumps({'query': query, 'response': response.decode('utf-8')}) + '\n'
+            with lock:
+                file.write(line)
+            return response
+        bodegha.graphql_request = recording
+        try:
+            bodegha.process_comments(repository, [], date, 0, 100, apikey)
+        finally:
+            bodegha.graphql_request = graphql_request
+
+
+def load_fixture(path):
+    fixture = {}
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            fixture[record['query']] = record['response'].encode('utf-8')
+    return fixture
+
+
+def replay(fixture):
+    """
+    Replaces bodegha.graphql_request by a lookup of the responses of the fixture.
+    """
+    def graphql_request(query, apikey, limiter=None):
+        if query not in fixture:
+            raise bodegha.BodeghaError(
+                'No recorded response for this query, the fixture has to be recorded again')
+        return fixture[query]
+    bodegha.graphql_request = graphql_request
+
+
+# --- Stages ---
+def measure(function, repeat):
+    """
+    Returns the best wall time of function over repeat runs, the peak memory it allocates
+    (measured in an additional run) and its result.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def accounts_of(comments):
+    params = bodegha.FEATURE_PARAMS
+    df = bodegha.select_comments(comments, [], [], 10, 100)
+    accounts = []
+    for author, group in df.groupby('author', observed=True):
+        bodies, counts = bodegha.unique_items(group[params['source']])
+        accounts.append((
+            author, len(group), int(group['empty'].sum()), bodies, counts, params, None))
+    return accounts
+
+
+def run_stages(repository, fixture, date, repeat):
+    """
+    Runs each stage on the comments of the fixture. Returns, by stage, its wall time, peak
+    memory, and the numbers of comments and accounts it processed.
+    """
+    import pandas
+    replay(fixture)
+    stages = {}
+
+    def add(stage, function, comments, accounts):
+        elapsed, peak, result = measure(function, repeat)
+        stages[stage] = {
+            'time': elapsed, 'peak': peak, 'comments': comments, 'accounts': accounts}
+        return result
+
+    def download():
+        return bodegha.process_comments(repository, [], date, 0, 100, 'fixture')
+
+    comments = download()
+    # Downloaded comments only keep the most recent ones of each author.
+    downloaded = int(bodegha.count_comments(comments).sum())
+    add('download', download, downloaded, comments['author'].nunique())
+
+    pages = [
+        bodegha.parse_response(response) for query, response in fixture.items()
+        if 'repository(' in query]
+
+    def extract():
+        columns = bodegha.new_comment_columns()
+        for page in pages:
+            for issue_type in ('pullRequests', 'issues'):
+                if issue_type in page:
+                    bodegha.extract_data(page, date, issue_type, columns, set(), None, [])
+        return bodegha.build_comments_frame(columns)
+
+    add('extract', extract, downloaded, comments['author'].nunique())
+
+    accounts = accounts_of(comments)
+    selected = sum(account[1] for account in accounts)
+
+    def distance():
+        for account in accounts:
+            bodegha.compute_distance(account[3], bodegha.FEATURE_PARAMS['func'])
+
+    add('distance', distance, selected, len(accounts))
+
+    features = add('features', lambda: bodegha.task(accounts), selected, len(accounts))
+    features = pandas.DataFrame(
+        data=[result for result, _, _ in features], columns=['account', 'comments', 'empty comments', 'patterns', 'dispersion'])
+
+    model = bodegha.get_model()
+    add('predict', lambda: bodegha.predict(model, features), selected, len(accounts))
+    return stages
+
+
+# --- Report and baselines ---
+def report(stages):
+    print('{:>10} {:>10} {:>12} {:>14} {:>14}'.format(
+        'stage', 'time (s)', 'peak (MiB)', 'comments/s', 'accounts/s'))
+    for stage, result in stages.items():
+        print('{:>10} {:>10.4f} {:>12.2f} {:>14.0f} {:>14.1f}'.format(
+            stage, result['time'], result['peak'] / 2**20,
+            result['comments'] / result['time'], result['accounts'] / result['time']))
+
+
+def compare(stages, baseline, tolerance):
+    """
+    Returns the regressions of the stages with respect to the baseline, as messages.
+    """
+    regressions = []
+    for stage, result in stages.items():
+        if stage not in baseline:
+            continue
+        for measurement in ('time', 'peak'):
+            before, after = baseline[stage][measurement], result[measurement]
+            if after > before * (1 + tolerance):
+                regressions.append('{} {}: {:.4g} -> {:.4g} (+{:.0%})'.format(
+                    stage, measurement, before, after, after / before - 1))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the stages of bodegha')
+    parser.add_argument('--authors', type=int, default=100)
+    parser.add_argument('--comments', type=int, default=100, help='Comments per author')
+    parser.add_argument('--body-length', type=int, default=20, help='Mean words per body')
+    parser.add_argument('--bot-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--repository', type=str, default='synthetic/repository')
+    parser.add_argument('--start-date', type=str, default=None)
+    parser.add_argument('--fixture', metavar='FILE', type=str, default=None,
+                        help='Replay the responses recorded in FILE')
+    parser.add_argument('--record', metavar='FILE', type=str, default=None,
+                        help='Record the responses of the API for the repository in FILE')
+    parser.add_argument('--key', metavar='APIKEY', type=str, default=None)
+    parser.add_argument('--save', metavar='FILE', type=str, default=None,
+                        help='Save the results as a baseline in FILE')
+    parser.add_argument('--compare', metavar='FILE', type=str, default=None,
+                        help='Fail if the results regress with respect to the baseline in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative regression (default=0.25)')
+    args = parser.parse_args()
+
+    if args.start_date is not None:
+        import dateutil.parser
+        date = dateutil.parser.parse(args.start_date)
+    else:
+        date = START - timedelta(days=1)
+
+    if args.record is not None:
+        if args.key is None:
+            parser.error('--record requires --key')
+        record(args.record, args.repository, args.key, date)
+        return
+
+    if args.fixture is not None:
+        fixture = load_fixture(args.fixture)
+    else:
+        items = generate_repository(
+            args.authors, args.comments, args.body_length, args.bot_ratio, args.seed)
+        fixture = synthetic_fixture(args.repository, items)
+
+    stages = run_stages(args.repository, fixture, date, args.repeat)
+    report(stages)
+
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump(stages, file, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            regressions = compare(stages, json.load(file), args.tolerance)
+        if regressions:
+            sys.exit('Regressions:\n' + '\n'.join(regressions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#  Benchmark of the start-up time of bodegha.py
+#
+#  Measures, over several cold processes, the import time of the module (as reported by
+#  python -X importtime), the time to print the help, and the time between the start of the
+#  command line and its first request to the GraphQL API, served here by a local server.
+#
+#  Usage: python benchmarks/bench_startup.py [--runs 10]
+
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bodegha.py')
+
+
+def import_time():
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import bodegha'],
+        cwd=os.path.dirname(MODULE), stderr=subprocess.PIPE, universal_newlines=True,
+        check=True).stderr
+    for line in output.splitlines():
+        if line.rstrip().endswith('| bodegha'):
+            return int(line.split('|')[1]) / 1e6
+    raise RuntimeError('bodegha not found in -X importtime output')
+
+
+def help_time():
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, MODULE, '--help'], stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def first_request_time():
+    arrivals = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            arrivals.append(time.perf_counter())
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    env = dict(os.environ, BODEGHA_GRAPHQL_URL='http://127.0.0.1:{}/graphql'.format(
+        server.server_address[1]))
+    try:
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, MODULE, 'owner/repository', '--key', 'x' * 40],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+    if len(arrivals) == 0:
+        raise RuntimeError('No request received')
+    return min(arrivals) - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the start-up time')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    for name, measure in [
+            ('import bodegha', import_time),
+            ('bodegha --help', help_time),
+            ('first GraphQL request', first_request_time)]:
+        values = [measure() for _ in range(args.runs)]
+        print('{:<24} median {:>7.1f} ms   min {:>7.1f} ms'.format(
+            name, statistics.median(values) * 1000, min(values) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,42 +18,166 @@ Descriptions
 
 
 # --- Prerequisites ---
-from multiprocessing import Pool
-import pandas
-import pickle
+# Heavy dependencies (pandas, numpy, scipy, scikit-learn, Levenshtein, tqdm, dateutil,
+# multiprocessing, urllib) are imported by the functions that need them, so that the command
+# line starts quickly and processes only import what their stage uses.
 import threading
-from Levenshtein import distance as lev
 import itertools
-from sklearn.cluster import DBSCAN
 import warnings
 import json
+import os
 import sys
-import dateutil
-import pkg_resources
-import numpy as np
-from dateutil.relativedelta import relativedelta
 from datetime import datetime
-try:
-    from urllib.request import urlopen, Request
-except ImportError:
-    from urllib2 import urlopen, Request
 import argparse
-from tqdm import tqdm
 import time
-from urllib.error import HTTPError
+import functools
 
 # --- Exception ---
 class BodeghaError(ValueError):
     pass
 
 
+# --- Metrics ---
+class Metrics:
+    """
+    Counters and stage timings of the process, shared by its threads. Counters and timings
+    only increase, so that they can be exported as Prometheus counters and summaries.
+    The feature time of each account is kept as well (the last one if it was computed
+    several times), unless keep_accounts is False, as in the prediction service, where only
+    their sum and number are kept.
+    """
+
+    COUNTERS = {
+        'graphql_requests': 'GraphQL requests sent',
+        'graphql_received_bytes': 'Bytes received from the GraphQL API',
+        'rate_limit_cost': 'Rate limit points consumed',
+        'revoked_keys': 'API keys found revoked',
+        'comments_parsed': 'Comments parsed from GraphQL responses',
+        'distance_pairs': 'Distances computed between comments',
+        'accounts': 'Accounts whose features were computed',
+        'predictions': 'Accounts whose type was predicted',
+        'prediction_cache_hits': 'Accounts whose features and prediction were cached',
+        'prediction_cache_misses': 'Accounts whose features and prediction were not cached',
+        'prediction_cache_evictions': 'Cached features and predictions evicted',
+        'account_index_hits': 'Accounts answered from the account index',
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.stages = {}
+        self.accounts = {}
+        self.account_count = 0
+        self.account_seconds = 0.0
+        self.keep_accounts = True
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def get(self, name):
+        return self.counters[name]
+
+    def record_stage(self, stage, seconds):
+        with self.lock:
+            count, total = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (count + 1, total + seconds)
+
+    def stage(self, stage):
+        """
+        Returns a context manager recording the time spent in its block under the given stage.
+        """
+        from contextlib import contextmanager
+
+        @contextmanager
+        def timer():
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.record_stage(stage, time.perf_counter() - start)
+        return timer()
+
+    def record_account(self, account, seconds):
+        with self.lock:
+            self.account_count += 1
+            self.account_seconds += seconds
+            if self.keep_accounts:
+                self.accounts[account] = seconds
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {
+                    stage: {'count': count, 'seconds': seconds}
+                    for stage, (count, seconds) in self.stages.items()},
+                'account_features': {
+                    'count': self.account_count, 'seconds': self.account_seconds},
+                'accounts': dict(self.accounts),
+            }
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        metrics = self.as_dict()
+        lines = []
+        for name, description in self.COUNTERS.items():
+            lines += [
+                '# HELP bodegha_{}_total {}.'.format(name, description),
+                '# TYPE bodegha_{}_total counter'.format(name),
+                'bodegha_{}_total {}'.format(name, metrics['counters'][name]),
+            ]
+        lines += [
+            '# HELP bodegha_stage_seconds Time spent in each stage.',
+            '# TYPE bodegha_stage_seconds summary',
+        ]
+        for stage, timing in sorted(metrics['stages'].items()):
+            lines += [
+                'bodegha_stage_seconds_sum{{stage="{}"}} {}'.format(stage, timing['seconds']),
+                'bodegha_stage_seconds_count{{stage="{}"}} {}'.format(stage, timing['count']),
+            ]
+        lines += [
+            '# HELP bodegha_account_feature_seconds Time spent computing the features of each '
+            'account.',
+            '# TYPE bodegha_account_feature_seconds summary',
+            'bodegha_account_feature_seconds_sum {}'.format(
+                metrics['account_features']['seconds']),
+            'bodegha_account_feature_seconds_count {}'.format(
+                metrics['account_features']['count']),
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, prometheus=False):
+        """
+        Writes the metrics to a file, as json or in the Prometheus text format.
+        """
+        with open(filename, 'w') as file:
+            if prometheus:
+                file.write(self.prometheus())
+            else:
+                json.dump(self.as_dict(), file, indent=2)
+
+
+METRICS = Metrics()
+
+
 # --- Download comments ---
-def get_comment_search_query(repository, pr, issue, beforePr, beforeIssue):
+GRAPHQL_URL = os.environ.get('BODEGHA_GRAPHQL_URL', 'https://api.github.com/graphql')
+MAX_RETRIES = 5
+# Longest wait before retrying a request, since GitHub resets rate limits every hour.
+MAX_BACKOFF = 3600
+KEYS_VARIABLE = 'BODEGHA_KEYS'
+THREADS_PER_QUERY = 20
+
+
+def get_comment_search_query(repository, pr, issue, beforePr, beforeIssue, order='CREATED_AT'):
 
     owner, name = repository.split('/')
 
     pulls = """
-        pullRequests(last:100 %s orderBy: {field: CREATED_AT, direction: ASC})
+        pullRequests(last:100 %s orderBy: {field: %s, direction: ASC})
         {
         totalCount
         pageInfo{
@@ -63,12 +187,14 @@ def get_comment_search_query(repository, pr, issue, beforePr, beforeIssue):
         edges{
             cursor
             node{
+            id
             author{
                 login
             }
             body
             number
             createdAt
+            updatedAt
             comments(first:100)
             {
                 totalCount
@@ -90,10 +216,10 @@ def get_comment_search_query(repository, pr, issue, beforePr, beforeIssue):
             }
         }
         }
-    """ % ('before:"'+beforePr+'"' if beforePr is not None else '')
+    """ % ('before:"'+beforePr+'"' if beforePr is not None else '', order)
 
     issues = """
-        issues(last:100 %s orderBy: {field: CREATED_AT, direction: ASC})
+        issues(last:100 %s orderBy: {field: %s, direction: ASC})
         {
         totalCount
         pageInfo{
@@ -103,14 +229,17 @@ def get_comment_search_query(repository, pr, issue, beforePr, beforeIssue):
         edges{
             cursor
             node{
+            id
             author{
                 login
             }
             body
             number
             createdAt
+            updatedAt
             comments(first:100)
             {
+                totalCount
                 pageInfo{
                     startCursor
                     endCursor
@@ -129,10 +258,15 @@ def get_comment_search_query(repository, pr, issue, beforePr, beforeIssue):
             }
         }
         }
-    """ % ('before:"'+beforeIssue+'"' if beforeIssue is not None else '')
+    """ % ('before:"'+beforeIssue+'"' if beforeIssue is not None else '', order)
 
     query = """
     {
+    rateLimit{
+        cost
+        remaining
+        resetAt
+    }
     repository(owner:"%s", name:"%s"){
         createdAt
         %s
@@ -143,118 +277,1502 @@ def get_comment_search_query(repository, pr, issue, beforePr, beforeIssue):
     return query
 
 
-def extract_data(data, date_limit, issue_type='issues'):
-    df = pandas.DataFrame()
+def get_thread_comments_query(threads):
+    """
+    Returns a query for the next comments of several issues or pull requests at once.
+    threads is a list of (node id, cursor) pairs, each one being fetched through an alias
+    since each thread has its own cursor.
+    """
+    comments = """
+            comments(first:100 after:"%s")
+            {
+                pageInfo{
+                    endCursor
+                    hasNextPage
+                }
+                edges{
+                node{
+                    author{
+                    login
+                    }
+                    body
+                    createdAt
+                }
+                }
+            }
+    """
+    nodes = ''.join(
+        """
+        t%d: node(id:"%s"){
+            ... on Issue{%s}
+            ... on PullRequest{%s}
+        }
+        """ % (index, node_id, comments % cursor, comments % cursor)
+        for index, (node_id, cursor) in enumerate(threads))
+
+    query = """
+    {
+    rateLimit{
+        cost
+        remaining
+        resetAt
+    }
+    %s
+    }
+    """ % nodes
+    return query
+
+
+COMMENT_TYPES = ['pullRequests', 'pullRequests_comment', 'issues', 'issues_comment']
+
+
+COMMENT_COLUMNS = ['author', 'body', 'number', 'created_at', 'type', 'empty']
+
+
+def new_comment_columns():
+    """
+    Returns empty column buffers that extract_data appends parsed comments to.
+    """
+    return {column: [] for column in COMMENT_COLUMNS}
+
+
+def append_comment(columns, node, number, comment_type):
+    body = node['body'] if node['body'] is not None else ""
+    columns['author'].append(node['author']['login'] if node['author'] is not None else None)
+    columns['body'].append(body)
+    columns['number'].append(number)
+    columns['created_at'].append(node['createdAt'])
+    columns['type'].append(comment_type)
+    columns['empty'].append(len(body) < 2)
+
+
+def build_comments_frame(columns):
+    """
+    Builds the comments DataFrame from column buffers in a single step, using compact dtypes.
+    """
+    import numpy as np
+    import pandas
+    return pandas.DataFrame({
+        'author': pandas.Categorical(columns['author']),
+        'body': pandas.Series(columns['body'], dtype=object),
+        'number': np.asarray(columns['number'], dtype=np.int64),
+        'created_at': pandas.to_datetime(
+            pandas.Series(columns['created_at'], dtype=object), utc=True).dt.tz_convert(None),
+        'type': pandas.Categorical(columns['type'], categories=COMMENT_TYPES),
+        'empty': np.asarray(columns['empty'], dtype=bool),
+    })
+
+
+class CommentWindows:
+    """
+    Keeps, for each author, the size most recent comments appended to it, and the number of
+    comments of each author, so that downloaded comments use O(authors x size) memory.
+    Comments with the same creation date are kept in order of appending, as a stable sort of
+    all comments would. Creation dates are compared as strings, as the API gives them in a
+    single format.
+    """
+
+    def __init__(self, size):
+        # Each author keeps at least one comment, that carries its number of comments.
+        self.size = max(size, 1)
+        self.windows = {}
+        self.counts = {}
+        self.appended = 0
+
+    def append(self, author, body, number, created_at, comment_type, empty):
+        import heapq
+        self.counts[author] = self.counts.get(author, 0) + 1
+        window = self.windows.setdefault(author, [])
+        # The oldest comment, and the last appended one of those that are as old, is at the
+        # top of the heap.
+        row = (author, body, number, created_at, comment_type, empty)
+        entry = (created_at, -self.appended, row)
+        self.appended += 1
+        if len(window) < self.size:
+            heapq.heappush(window, entry)
+        elif entry[:2] > window[0][:2]:
+            heapq.heapreplace(window, entry)
+
+    def extend(self, columns):
+        """
+        Appends the comments of column buffers (see new_comment_columns), and empties them.
+        """
+        for row in zip(*(columns[column] for column in COMMENT_COLUMNS)):
+            self.append(*row)
+        for values in columns.values():
+            del values[:]
+
+    def rows(self):
+        """
+        Returns the kept comments in order of appending.
+        """
+        entries = [entry for window in self.windows.values() for entry in window]
+        entries.sort(key=lambda entry: entry[1], reverse=True)
+        return [row for _, _, row in entries]
+
+    def merge(self, other):
+        """
+        Appends the kept comments of another CommentWindows, and counts the other ones.
+        """
+        for row in other.rows():
+            self.append(*row)
+        for author, count in other.counts.items():
+            self.counts[author] += count - len(other.windows[author])
+
+    def frame(self):
+        """
+        Returns the kept comments (see build_comments_frame) in order of appending, with the
+        number of comments of their author in an author_comments column (see count_comments).
+        """
+        import numpy as np
+        rows = self.rows()
+        columns = {
+            column: [row[index] for row in rows] for index, column in enumerate(COMMENT_COLUMNS)}
+        comments = build_comments_frame(columns)
+        comments['author_comments'] = np.asarray(
+            [self.counts[row[0]] for row in rows], dtype=np.int64)
+        return comments
+
+
+def parse_response(data, limiter=None):
+    """
+    Decodes a GraphQL response and returns its repository object, or None if it has no data.
+    The rateLimit object of the response, if any, is recorded in the given RateLimiter.
+    """
     json_object = json.loads(data.decode('utf-8'))
     if 'data' not in json_object:
-        return
-    data = json_object["data"]["repository"]
-    if data == None:
+        return None
+    if limiter is not None and json_object["data"].get("rateLimit") is not None:
+        limiter.record(json_object["data"]["rateLimit"])
+    repository = json_object["data"]["repository"]
+    if repository is None:
         raise BodeghaError(json_object["errors"][0]["message"])
+    return repository
+
+
+def extract_data(data, date_limit, issue_type, columns, numbers, since=None, truncated=None):
+    """
+    Appends the issues (or pull requests) of a parsed page that were created after date_limit,
+    and their comments, to the column buffers. The numbers of the kept issues are added to
+    the given set. Kept issues having more comments than the page contains are added to the
+    truncated list as (issue type, number, node id, cursor of the last comment) tuples.
+    If since is given (pages ordered by update date), only the issues updated after since are
+    kept, and the page is considered as the last one when it reaches an issue that was not
+    updated since then.
+    Returns the total number of issues, the number of issues in the page, its start cursor,
+    the date of the issue that ends the pagination (or None) and the latest update date of
+    the kept issues (or None).
+    """
+    import dateutil.parser
     issue_total = data[issue_type]['totalCount']
     start_cursor = data[issue_type]['pageInfo']['startCursor']
     issue_count = len(data[issue_type]['edges'])
     last_date = None
+    updated_at = None
     for issue in data[issue_type]['edges']:
         issue = issue['node']
         date = dateutil.parser.parse(issue['createdAt'], ignoretz=True)
         if date is None:
             continue
-        if date > date_limit:
-            df = pandas.concat([df, pandas.DataFrame([{
-                'author': (issue['author']['login'] if (issue['author'] is not None) else np.nan),
-                'body': (issue['body'] if issue['body'] is not None else ""),
-                'number': issue['number'],
-                'created_at': date,
-                'type': issue_type,
-                'empty': (1 if len(issue['body']) < 2 else 0)
-            }])], ignore_index=True)
+        if since is not None and issue['updatedAt'] <= since:
+            last_date = date
+        elif date > date_limit:
+            append_comment(columns, issue, issue['number'], issue_type)
+            numbers.add(issue['number'])
             for comment in issue['comments']['edges']:
-                comment = comment['node']
-                df = pandas.concat([df, pandas.DataFrame([{
-                    'author': (
-                        comment['author']['login'] if (comment['author'] is not None) else np.nan
-                        ),
-                    'body': comment['body'],
-                    'number': issue['number'],
-                    'created_at': dateutil.parser.parse(comment['createdAt'], ignoretz=True),
-                    'type': issue_type + "_comment",
-                    'empty': (1 if len(comment['body']) < 2 else 0)
-                }])], ignore_index=True)
-        else:
+                append_comment(columns, comment['node'], issue['number'], issue_type + "_comment")
+            if truncated is not None \
+                    and issue['comments']['totalCount'] > len(issue['comments']['edges']):
+                truncated.append((
+                    issue_type, issue['number'], issue['id'],
+                    issue['comments']['pageInfo']['endCursor']))
+            if updated_at is None or issue['updatedAt'] > updated_at:
+                updated_at = issue['updatedAt']
+        elif since is None:
             last_date = date
-    return df, issue_total, issue_count, start_cursor, last_date
+    return issue_total, issue_count, start_cursor, last_date, updated_at
+
+
+class DownloadJournal:
+    """
+    Append-only journal of the pages downloaded by fetch_comments, so that an interrupted
+    download can be resumed without downloading them again. After a header with the
+    parameters of the download, each line is the json record of a page: its stream
+    (pullRequests, issues or threads), the comments it added to the column buffers and what
+    is needed to continue after it. Records are flushed to disk as they are written, and
+    the partial record left by a crash is dropped when the journal is resumed.
+    """
+
+    def __init__(self, filename, header, resume=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.header = header
+        self.resumed = False
+        self.size = 0
+        if resume and os.path.exists(filename):
+            with open(filename, 'rb') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    if self.size == 0:
+                        self.header = record
+                    self.size += len(line)
+            self.resumed = self.size > 0
+        self.file = open(filename, 'r+b' if self.resumed else 'wb')
+        self.file.truncate(self.size)
+        self.file.seek(self.size)
+        if not self.resumed:
+            self.write(self.header)
+
+    def write(self, record):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def replay(self, stream):
+        """
+        Yields the records of the given stream that were in the journal when it was resumed.
+        """
+        if not self.resumed:
+            return
+        with open(self.filename, 'rb') as file:
+            file.readline()
+            position = file.tell()
+            for line in file:
+                position += len(line)
+                if position > self.size:
+                    break
+                record = json.loads(line.decode('utf-8'))
+                if record['stream'] == stream:
+                    yield record
+
+    def close(self, complete=False):
+        """
+        Closes the journal, and removes it if the download is complete.
+        """
+        self.file.close()
+        if complete:
+            self.remove()
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+# Directory of the download journals when no cache directory is given.
+JOURNAL_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'bodegha')
+
+
+def open_journal(journal, repository, date):
+    """
+    Opens the download journal of a repository, given journal as a (directory, resume) pair.
+    If resume is True and the journal of an interrupted download exists, the download is
+    resumed, with the start date it was started with (see the date attribute of the returned
+    journal). The journal of a failed download is only kept if resume is True.
+    """
+    import dateutil.parser
+    from tqdm import tqdm
+    directory, resume = journal
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(
+        directory, 'journal-{}.jsonl'.format(repository.replace('/', '_')))
+    journal = DownloadJournal(
+        filename, {'repository': repository, 'date': date.isoformat()}, resume)
+    journal.date = dateutil.parser.parse(journal.header['date'])
+    if journal.resumed:
+        tqdm.write(
+            'Resuming the interrupted download of {} (start date {}).'.format(
+                repository, journal.header['date']), file=sys.stderr)
+    return journal
+
+
+def journal_columns(columns, start):
+    """
+    Returns the values appended to the column buffers since start, to be journaled.
+    """
+    return {column: values[start:] for column, values in columns.items()}
+
+
+def replay_columns(columns, record):
+    """
+    Appends the comments of a journal record to the column buffers. Returns their number.
+    """
+    for column, values in record['comments'].items():
+        columns[column].extend(values)
+    return len(record['comments']['author'])
+
+
+def fetch_stream(repository, apikey, issue_type, date, columns, numbers, since, before, limiter,
+                 cancelled, truncated, window=None, journal=None):
+    """
+    Pages the pull requests or the issues of a repository backward from the given cursor,
+    appending their comments to the column buffers and their truncated comment threads to
+    the truncated list. If a CommentWindows is given, the comments of each page are moved
+    from the column buffers to it. Stops early if cancelled is set.
+    If a DownloadJournal is given, the pages it contains are replayed first, and the pages
+    that are downloaded are added to it.
+    Returns the cursor of the page where the pagination stopped because of date or since
+    (None for the first page) or False if all pages were fetched, and the latest update date
+    of the kept issues. Returns None if the download failed.
+    """
+    order = 'CREATED_AT' if since is None else 'UPDATED_AT'
+    pr = issue_type == 'pullRequests'
+    updated_at = None
+    if journal is not None:
+        for record in journal.replay(issue_type):
+            replay_columns(columns, record)
+            numbers.update(record['numbers'])
+            truncated.extend(tuple(thread) for thread in record['truncated'])
+            updated_at = max(filter(None, [updated_at, record['updated_at']]), default=None)
+            if window is not None:
+                window.extend(columns)
+            if record['done']:
+                return record['stopped'], updated_at
+            before = record['before']
+
+    while not cancelled.is_set():
+        data = download_comments(
+            repository, apikey, pr, not pr, before if pr else None, None if pr else before,
+            order, limiter)
+        data = parse_response(data, limiter)
+        if data is None:
+            return None
+
+        parsed = len(columns['author'])
+        parsed_threads = len(truncated)
+        issue_total, issue_count, end_cursor, last_date, page_updated_at = \
+            extract_data(data, date, issue_type, columns, numbers, since, truncated)
+        METRICS.add('comments_parsed', len(columns['author']) - parsed)
+        if journal is not None:
+            comments = journal_columns(columns, parsed)
+            page = {
+                'stream': issue_type,
+                'comments': comments,
+                # The issues themselves are appended with the type of the stream.
+                'numbers': sorted({
+                    number for number, comment_type in zip(comments['number'], comments['type'])
+                    if comment_type == issue_type}),
+                'truncated': truncated[parsed_threads:],
+                'updated_at': page_updated_at,
+            }
+        if window is not None:
+            window.extend(columns)
+        updated_at = max(filter(None, [updated_at, page_updated_at]), default=None)
+
+        if last_date is None and issue_total > len(numbers) and issue_count == 100:
+            before = end_cursor
+            if journal is not None:
+                journal.write(dict(page, done=False, before=before))
+        else:
+            stopped = before if last_date is not None else False
+            if journal is not None:
+                journal.write(dict(page, done=True, stopped=stopped))
+            return stopped, updated_at
+    return None
+
+
+def fetch_comments(repository, apikey, date, columns, downloaded, since=None, before=None,
+                   limiter=None, window=None, journal=None):
+    """
+    Pages pull requests and issues backward, appending their comments to the column buffers
+    (see extract_data). Pages are ordered by creation date, or by update date if since is
+    given. before maps each type ('pullRequests', 'issues') to the cursor to start from;
+    a type that is not in before is not fetched. Both types are fetched concurrently and
+    share the given RateLimiter. If a CommentWindows is given, the comments are appended to
+    it instead of the column buffers, page by page. If a DownloadJournal is given, the
+    download is resumed from it and journaled (see fetch_stream and fetch_threads).
+    Returns, for each fetched type, the cursor of the page where the pagination stopped
+    because of date or since (None for the first page) or False if all pages were fetched,
+    and the latest update date of the kept issues. Returns None if the download failed.
+    """
+    from tqdm import tqdm
+    from concurrent.futures import ThreadPoolExecutor
+    if before is None:
+        before = {'pullRequests': None, 'issues': None}
+    if limiter is None:
+        limiter = new_limiter(apikey)
+    if len(before) == 0:
+        return {}, None
+
+    cancelled = threading.Event()
+    streams = {issue_type: new_comment_columns() for issue_type in before}
+    windows = {
+        issue_type: CommentWindows(window.size) if window is not None else None
+        for issue_type in before}
+    truncated = {issue_type: [] for issue_type in before}
+
+    def fetch(issue_type):
+        try:
+            return fetch_stream(
+                repository, apikey, issue_type, date, streams[issue_type],
+                downloaded[issue_type], since, before[issue_type], limiter, cancelled,
+                truncated[issue_type], windows[issue_type], journal)
+        except BaseException:
+            cancelled.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=len(before)) as executor:
+        futures = [(issue_type, executor.submit(fetch, issue_type)) for issue_type in before]
+        results = [(issue_type, future.result()) for issue_type, future in futures]
+
+    stopped = {}
+    updated_at = None
+    for issue_type, result in results:
+        if result is None:
+            return None
+        stopped[issue_type], stream_updated_at = result
+        updated_at = max(filter(None, [updated_at, stream_updated_at]), default=None)
+        for column, values in streams[issue_type].items():
+            columns[column].extend(values)
+        if window is not None:
+            window.merge(windows[issue_type])
+
+    threads = [thread for issue_type in before for thread in truncated[issue_type]]
+    if len(threads) > 0:
+        requests, cost = limiter.requests, limiter.used
+        if fetch_threads(apikey, threads, columns, limiter, journal) is None:
+            return None
+        tqdm.write(
+            "Fetched the remaining comments of {} long threads with {} extra requests "
+            "(rate limit cost: {}).".format(
+                len(threads), limiter.requests - requests, limiter.used - cost),
+            file=sys.stderr)
+        if window is not None:
+            window.extend(columns)
+    return stopped, updated_at
+
+
+def fetch_threads(apikey, threads, columns, limiter, journal=None):
+    """
+    Fetches the comments that did not fit in the first page of the given truncated threads
+    (see extract_data), THREADS_PER_QUERY threads per request, and appends them to the column
+    buffers. If a DownloadJournal is given, the requests it contains are replayed first, and
+    the remaining threads after each request are added to it. Returns None if the download
+    failed.
+    """
+    threads = list(threads)
+    if journal is not None:
+        for record in journal.replay('threads'):
+            replay_columns(columns, record)
+            threads = [tuple(thread) for thread in record['threads']]
+    while len(threads) > 0:
+        parsed = len(columns['author'])
+        batch, threads = threads[:THREADS_PER_QUERY], threads[THREADS_PER_QUERY:]
+        data = graphql_request(
+            get_thread_comments_query([(node_id, cursor) for _, _, node_id, cursor in batch]),
+            apikey, limiter)
+        json_object = json.loads(data.decode('utf-8'))
+        if 'data' not in json_object:
+            return None
+        data = json_object['data']
+        if data.get('rateLimit') is not None:
+            limiter.record(data['rateLimit'])
+        for index, (issue_type, number, node_id, cursor) in enumerate(batch):
+            node = data.get('t%d' % index)
+            if node is None or 'comments' not in node:
+                continue
+            for comment in node['comments']['edges']:
+                append_comment(columns, comment['node'], number, issue_type + "_comment")
+            METRICS.add('comments_parsed', len(node['comments']['edges']))
+            if node['comments']['pageInfo']['hasNextPage']:
+                threads.append(
+                    (issue_type, number, node_id, node['comments']['pageInfo']['endCursor']))
+        if journal is not None:
+            journal.write({
+                'stream': 'threads',
+                'comments': journal_columns(columns, parsed),
+                'threads': threads,
+            })
+    return columns
+
+
+def process_comments(repository, accounts, date, min_comments, max_comments, apikey,
+                     cache_dir=None, refresh=False, journal=None):
+    """
+    Downloads the comments of the issues and pull requests created after date. Only the
+    max_comments most recent comments of each author are kept, and the number of comments of
+    each author (see CommentWindows). If cache_dir is given, the comments are kept in a local
+    store and only the issues and pull requests updated since the previous run are downloaded,
+    unless refresh is True.
+    If journal is given as a (directory, resume) pair, the full download of the comments is
+    journaled there so that it can be resumed if it fails (see open_journal).
+    """
+    with METRICS.stage('download'):
+        if cache_dir is not None:
+            return process_cached_comments(
+                repository, date, apikey, cache_dir, refresh, journal)
+
+        columns = new_comment_columns()
+        downloaded = {'pullRequests': set(), 'issues': set()}
+        window = CommentWindows(max_comments)
+        resume = journal is not None and journal[1]
+        if journal is not None:
+            journal = open_journal(journal, repository, date)
+            date = journal.date
+        fetched = None
+        try:
+            fetched = fetch_comments(
+                repository, apikey, date, columns, downloaded, window=window, journal=journal)
+        finally:
+            if journal is not None:
+                journal.close(fetched is not None or not resume)
+        if fetched is None:
+            return None
+        return window.frame()
 
 
-def process_comments(repository, accounts, date, min_comments, max_comments, apikey):
-    comments = pandas.DataFrame()
-    pr = True
-    issue = True
-    beforePr = None
-    beforeIssue = None
-    while issue or pr:
+class RateLimiter:
+    """
+    Tracks the GitHub GraphQL rate limit of an API key from the X-RateLimit-* headers and the
+    rateLimit object of the responses. Requests only wait when the remaining points are not
+    enough for the requests in flight, and only until the limit is reset.
+    For more details, see the following documentation:
+    https://docs.github.com/en/graphql/overview/resource-limitations.
+    """
 
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset = None
+        self.cost = 1
+        self.used = 0
+        self.requests = 0
+        self.in_flight = 0
+
+    def update(self, headers):
+        """
+        Records the X-RateLimit-Remaining and X-RateLimit-Reset headers of a response.
+        """
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        with self.lock:
+            if remaining is not None:
+                self.remaining = int(remaining)
+            if reset is not None:
+                self.reset = float(reset)
+
+    def record(self, rate_limit):
+        """
+        Records the rateLimit object (cost, remaining, resetAt) of a GraphQL response.
+        """
+        import dateutil.parser
+        METRICS.add('rate_limit_cost', rate_limit['cost'])
+        with self.lock:
+            self.cost = max(rate_limit['cost'], 1)
+            self.used += rate_limit['cost']
+            self.remaining = rate_limit['remaining']
+            self.reset = dateutil.parser.parse(rate_limit['resetAt']).timestamp()
+
+    def delay(self):
+        """
+        Returns how long a new request has to wait for the rate limit to be reset.
+        """
+        with self.lock:
+            if self.remaining is None or self.reset is None:
+                return 0
+            if self.remaining >= self.cost * (self.in_flight + 1):
+                return 0
+            # The rate limit was reset since the remaining points were recorded.
+            if self.clock() > self.reset:
+                return 0
+            return self.until_reset()
+
+    def until_reset(self):
+        """
+        Returns how long to wait for the rate limit to be reset, at most MAX_BACKOFF seconds.
+        """
+        return min(max(self.reset - self.clock(), 0) + 1, MAX_BACKOFF)
+
+    def retry_after(self, value):
+        """
+        Returns the delay of a Retry-After header, given in seconds or as an HTTP date, at most
+        MAX_BACKOFF seconds, or None if it is invalid.
+        """
+        import math
+        from email.utils import parsedate_to_datetime
         try:
-            data = download_comments(repository, apikey, pr, issue, beforePr, beforeIssue)
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - self.clock()
+            except (TypeError, ValueError):
+                return None
+        if not math.isfinite(delay):
+            return None
+        return min(max(delay, 0), MAX_BACKOFF)
+
+    def wait(self):
+        from tqdm import tqdm
+        delay = self.delay()
+        if delay > 0:
+            tqdm.write(
+                "Wait {:.0f} seconds, to prevent exceeding the rate limit of GitHub..."
+                .format(delay), file=sys.stderr)
+            self.pause(delay)
+            tqdm.write("Continue downloading...", file=sys.stderr)
+
+    def pause(self, delay):
+        """
+        Waits for the given time, after which the remaining points are not known anymore.
+        """
+        self.sleep(delay)
+        with self.lock:
+            self.remaining = None
+
+    def backoff(self, error, attempt):
+        """
+        Returns how long to wait before retrying a request that failed with the given
+        HTTPError, or None if it should not be retried. A request is retried at most
+        MAX_RETRIES times, and waits at most MAX_BACKOFF seconds.
+        """
+        if attempt >= MAX_RETRIES:
+            return None
+        headers = error.headers if error.headers is not None else {}
+        retry_after = headers.get('Retry-After')
+        delay = self.retry_after(retry_after) if retry_after is not None else None
+        if delay is not None:
+            return delay
+        if headers.get('X-RateLimit-Remaining') == '0':
+            self.update(headers)
+            if self.reset is not None:
+                return self.until_reset()
+        # GitHub answers 502 when a query times out or the rate limit is exceeded: retry
+        # with an exponential backoff, or wait for the reset if no point is left.
+        if error.code in (502, 503, 504):
+            with self.lock:
+                if self.remaining is not None and self.reset is not None \
+                        and self.remaining < self.cost:
+                    return self.until_reset()
+            return min(2 ** attempt, 60)
+        return None
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+            self.requests += 1
+
+    def finish(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def __enter__(self):
+        self.wait()
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finish()
+
+
+class KeyPool:
+    """
+    Spreads the requests over several API keys, each with its own RateLimiter. A request uses
+    the key that has the most remaining points and does not have to wait, and keys that are
+    revoked (401 responses) are not used anymore. Requests only wait when all keys are
+    exhausted, until the first one is reset.
+    A KeyPool is given as the API key of the download functions, and used as their rate
+    limiter (see new_limiter): the key of a request is the one acquired by its thread.
+    """
+
+    def __init__(self, keys, clock=time.time, sleep=time.sleep):
+        if len(keys) == 0:
+            raise BodeghaError('At least one API key is required.')
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.limiters = {key: RateLimiter(clock, sleep) for key in keys}
+        self.revoked = set()
+        self.local = threading.local()
+
+    def __len__(self):
+        return len(self.limiters) - len(self.revoked)
+
+    @property
+    def requests(self):
+        return sum(limiter.requests for limiter in self.limiters.values())
+
+    @property
+    def used(self):
+        return sum(limiter.used for limiter in self.limiters.values())
+
+    def current(self):
+        """
+        Returns the key acquired by the current thread.
+        """
+        return self.local.key
+
+    def acquire(self):
+        """
+        Selects the key of a new request. Keys whose remaining points are unknown are tried
+        first, then the ones with the most remaining points, and the ones with the fewest
+        requests in flight among them, so that concurrent requests use different keys.
+        """
+        while True:
+            with self.lock:
+                active = [key for key in self.limiters if key not in self.revoked]
+                if len(active) == 0:
+                    raise BodeghaError('All the API keys were revoked.')
+                ready = [key for key in active if self.limiters[key].delay() == 0]
+                if len(ready) > 0:
+                    key = max(ready, key=lambda key: (
+                        self.limiters[key].remaining is None,
+                        self.limiters[key].remaining or 0,
+                        -self.limiters[key].in_flight))
+                    self.limiters[key].start()
+                    self.local.key = key
+                    return key
+                # Wait for the first key to be reset, outside of the lock.
+                first = min(active, key=lambda key: self.limiters[key].delay())
+            self.limiters[first].wait()
+
+    def update(self, headers):
+        self.limiters[self.current()].update(headers)
+
+    def pause(self, delay):
+        self.limiters[self.current()].pause(delay)
+
+    def record(self, rate_limit):
+        self.limiters[self.current()].record(rate_limit)
+
+    def backoff(self, error, attempt):
+        """
+        Returns how long to wait before retrying a failed request (see RateLimiter.backoff).
+        The request is retried at once, with another key, if its key is revoked or exhausted
+        and another key is available.
+        """
+        key = self.current()
+        limiter = self.limiters[key]
+        if error.code == 401:
+            with self.lock:
+                self.revoked.add(key)
+                if len(self) == 0:
+                    return None
+            METRICS.add('revoked_keys')
+            return 0
+        delay = limiter.backoff(error, attempt)
+        if delay is None or limiter.delay() == 0:
+            return delay
+        with self.lock:
+            available = any(
+                self.limiters[other].delay() == 0
+                for other in self.limiters if other != key and other not in self.revoked)
+        return 0 if available else delay
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.limiters[self.current()].finish()
+
+
+def new_limiter(apikey):
+    """
+    Returns the rate limiter of the requests sent with the given API key: the KeyPool itself
+    if apikey is one, or a new RateLimiter.
+    """
+    return apikey if isinstance(apikey, KeyPool) else RateLimiter()
+
+
+def read_body(response):
+    """
+    Reads the body of an HTTP response, decompressing it while it arrives if it is gzip or
+    deflate encoded, and counts the bytes received in the metrics.
+    """
+    import zlib
+    encoding = (response.headers.get('Content-Encoding') or '').lower()
+    if encoding not in ('gzip', 'deflate'):
+        data = response.read()
+        METRICS.add('graphql_received_bytes', len(data))
+        return data
+    # Accepts both gzip and zlib headers.
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    parts = []
+    while True:
+        chunk = response.read(65536)
+        if not chunk:
+            break
+        METRICS.add('graphql_received_bytes', len(chunk))
+        parts.append(decompressor.decompress(chunk))
+    parts.append(decompressor.flush())
+    return b''.join(parts)
+
+
+class HTTPTransport:
+    """
+    Sends POST requests over persistent HTTP/1.1 connections. Idle connections are kept in a
+    pool per host, so that concurrent downloads each reuse their own connection instead of
+    opening (and negotiating TLS for) a new one for every page.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def connection(self, scheme, host):
+        """
+        Returns an idle connection to host, or a new one, and whether it was reused.
+        """
+        import http.client
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    def release(self, scheme, host, connection):
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(connection)
+
+    def post(self, url, data, headers):
+        """
+        Sends data to url and returns the status, headers and body of the response.
+        """
+        import http.client
+        from urllib.parse import urlsplit
+        url = urlsplit(url)
+        path = (url.path or '/') + ('?' + url.query if url.query else '')
+        while True:
+            connection, reused = self.connection(url.scheme, url.netloc)
+            try:
+                connection.request('POST', path, body=data, headers=headers)
+                response = connection.getresponse()
+                body = read_body(response)
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                # The server may have closed an idle connection in the meantime.
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(url.scheme, url.netloc, connection)
+            return response.status, response.headers, body
+
+
+class UrllibTransport:
+    """
+    Sends POST requests with urllib, one connection per request. Used when a proxy is
+    configured, since urllib handles proxies.
+    """
+
+    def post(self, url, data, headers):
+        from urllib.request import urlopen, Request
+        from urllib.error import HTTPError
+        try:
+            response = urlopen(Request(url, data, headers))
         except HTTPError as err:
-            # If the rate limit score of the GitHub GraphQL API exceeds the rate limit,
-            # an HTTP 502 error is raised.
-            # If so, wait an hour to make sure that the score is properly
-            # reset in order to continue.
-            # For more details, see the following documentation:
-            # https://docs.github.com/en/graphql/overview/resource-limitations.
-            if err.code == 502:
-                tqdm.write("Wait for one hour, to prevent exceeding the rate limit of GitHub...")
-                time.sleep(3700)
-                tqdm.write("Continue downloading...")
-                data = download_comments(repository, apikey, pr, issue, beforePr, beforeIssue)
+            return err.code, err.headers, read_body(err)
+        with response:
+            return response.status, response.headers, read_body(response)
+
+
+TRANSPORT = None
+TRANSPORT_LOCK = threading.Lock()
+
+
+def get_transport():
+    """
+    Returns the transport of GraphQL requests. Any object with a post(url, data, headers)
+    method returning the status, headers and body of the response can be assigned to
+    TRANSPORT instead, e.g., to serve requests from a local mock server.
+    """
+    global TRANSPORT
+    with TRANSPORT_LOCK:
+        if TRANSPORT is None:
+            from urllib.parse import urlsplit
+            from urllib.request import getproxies, proxy_bypass
+            url = urlsplit(GRAPHQL_URL)
+            if url.scheme in getproxies() and not proxy_bypass(url.hostname):
+                TRANSPORT = UrllibTransport()
             else:
+                TRANSPORT = HTTPTransport()
+        return TRANSPORT
+
+
+def graphql_request(query, apikey, limiter=None, transport=None):
+    """
+    Sends a query to the GitHub GraphQL API and returns the raw response, retrying failed
+    requests and waiting for the rate limit as told by the given RateLimiter. If apikey is a
+    KeyPool, each request is sent with the key it selects (see new_limiter). Responses are
+    requested compressed, through the given transport or the default one (see get_transport).
+    Failed requests raise urllib's HTTPError.
+    """
+    import io
+    from tqdm import tqdm
+    from urllib.error import HTTPError
+    if limiter is None:
+        limiter = new_limiter(apikey)
+    if transport is None:
+        transport = get_transport()
+    data = json.dumps({"query": query}).encode('utf-8')
+    headers = {
+        "User-Agent": "Mozilla/5.0",
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "Content-Type": "application/json",
+    }
+    for attempt in itertools.count():
+        try:
+            with limiter:
+                key = apikey.current() if isinstance(apikey, KeyPool) else apikey
+                headers["Authorization"] = "Bearer {}".format(key)
+                status, response_headers, body = transport.post(
+                    GRAPHQL_URL, data, dict(headers))
+                limiter.update(response_headers)
+            METRICS.add('graphql_requests')
+            if status >= 400:
+                raise HTTPError(
+                    GRAPHQL_URL, status, 'HTTP Error {}'.format(status), response_headers,
+                    io.BytesIO(body))
+            return body
+        except HTTPError as err:
+            delay = limiter.backoff(err, attempt)
+            if delay is None:
                 raise
+            if delay == 0 and isinstance(limiter, KeyPool):
+                tqdm.write(
+                    "HTTP error {}, retry with another API key...".format(err.code),
+                    file=sys.stderr)
+                continue
+            tqdm.write(
+                "HTTP error {}, retry in {:.0f} seconds...".format(err.code, delay),
+                file=sys.stderr)
+            limiter.pause(delay)
+
 
-        if pr:
-            df_pr, pr_total, pr_count, pr_end_cursor, last_pr \
-                = extract_data(data, date, 'pullRequests')
-            comments = pandas.concat([comments, df_pr], ignore_index=True)
-        if issue:
-            df_issues, issue_total, issue_count, issue_end_cursor, last_issue = \
-                extract_data(data, date, 'issues')
-            comments = pandas.concat([comments, df_issues], ignore_index=True)
-
-        if len(comments)>0:
-            downloaded_issues = \
-                len(comments[lambda x: x['type'] == 'issues'].drop_duplicates('number'))
-            downloaded_prs = \
-                len(comments[lambda x: x['type'] == 'pullRequests'].drop_duplicates('number'))
-
-        if issue and last_issue is None and issue_total > downloaded_issues:
-            issue = True
-            beforeIssue = issue_end_cursor
+def download_comments(repository, apikey, pr=True, issue=True, beforePr=None, beforeIssue=None,
+                      order='CREATED_AT', limiter=None):
+    return graphql_request(
+        get_comment_search_query(repository, pr, issue, beforePr, beforeIssue, order),
+        apikey, limiter)
+
+
+# --- Comment store ---
+STORE_FILENAME = 'comments.sqlite'
+
+
+def open_store(cache_dir):
+    """
+    Opens (and creates if needed) the local comment store located in cache_dir.
+    """
+    import sqlite3
+    os.makedirs(cache_dir, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(cache_dir, STORE_FILENAME), timeout=60)
+    # Account states stored by previous versions, with cluster labels and float64 distances,
+    # are dropped: they are computed again.
+    if 'labels' in [row[1] for row in connection.execute('PRAGMA table_info(account_states)')]:
+        connection.execute('DROP TABLE account_states')
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS repositories (
+            repository TEXT PRIMARY KEY,
+            start_date TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            pr_cursor TEXT,
+            pr_complete INTEGER NOT NULL,
+            issue_cursor TEXT,
+            issue_complete INTEGER NOT NULL,
+            accessed_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS comments (
+            repository TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            author TEXT,
+            body TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            empty INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS comments_repository_number ON comments (repository, number);
+        CREATE TABLE IF NOT EXISTS account_states (
+            repository TEXT NOT NULL,
+            author TEXT NOT NULL,
+            key TEXT NOT NULL,
+            bodies TEXT NOT NULL,
+            distances BLOB NOT NULL,
+            PRIMARY KEY (repository, author, key)
+        );
+        CREATE TABLE IF NOT EXISTS predictions (
+            key TEXT PRIMARY KEY,
+            features TEXT NOT NULL,
+            prediction TEXT NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS predictions_accessed_at ON predictions (accessed_at);
+        CREATE TABLE IF NOT EXISTS account_index (
+            login TEXT PRIMARY KEY,
+            comments TEXT NOT NULL,
+            features TEXT,
+            prediction TEXT,
+            confidence REAL,
+            accessed_at TEXT NOT NULL
+        );
+    """)
+    return connection
+
+
+def load_store_state(connection, repository):
+    """
+    Returns what is known about the stored comments of a repository, or None if there are none.
+    start_date is the creation date after which all issues are stored, updated_at the latest
+    update date of the stored issues (the high-water mark for the next refresh) and before the
+    cursors to extend the stored issues before start_date (types that are complete are omitted).
+    """
+    import dateutil.parser
+    row = connection.execute(
+        'SELECT start_date, updated_at, pr_cursor, pr_complete, issue_cursor, issue_complete '
+        'FROM repositories WHERE repository = ?', (repository,)).fetchone()
+    if row is None:
+        return None
+    start_date, updated_at, pr_cursor, pr_complete, issue_cursor, issue_complete = row
+    before = {}
+    if not pr_complete:
+        before['pullRequests'] = pr_cursor
+    if not issue_complete:
+        before['issues'] = issue_cursor
+    return {
+        'start_date': dateutil.parser.parse(start_date),
+        'updated_at': updated_at,
+        'before': before,
+    }
+
+
+def save_store_state(connection, repository, start_date, updated_at, before):
+    connection.execute(
+        'INSERT OR REPLACE INTO repositories VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (
+            repository,
+            start_date.isoformat(),
+            updated_at,
+            before.get('pullRequests') or None,
+            before.get('pullRequests', False) is False,
+            before.get('issues') or None,
+            before.get('issues', False) is False,
+            datetime.now().isoformat(),
+        ))
+
+
+def store_comments(connection, repository, columns, numbers):
+    """
+    Replaces the stored comments of the given issue and pull request numbers by the comments
+    in the column buffers.
+    """
+    connection.executemany(
+        'DELETE FROM comments WHERE repository = ? AND number = ?',
+        ((repository, number) for number in numbers))
+    connection.executemany(
+        'INSERT INTO comments VALUES (?, ?, ?, ?, ?, ?, ?)',
+        zip(
+            itertools.repeat(repository), columns['number'], columns['type'], columns['author'],
+            columns['body'], columns['created_at'], columns['empty']))
+
+
+def read_stored_comments(connection, repository, date):
+    """
+    Returns column buffers with the stored comments of the issues and pull requests of a
+    repository that were created after date.
+    """
+    import dateutil.parser
+    rows = connection.execute(
+        'SELECT number, type, author, body, created_at, empty FROM comments '
+        'WHERE repository = ? ORDER BY rowid', (repository,)).fetchall()
+    numbers = set(
+        number for number, issue_type, _, _, created_at, _ in rows
+        if issue_type in ('pullRequests', 'issues')
+        and dateutil.parser.parse(created_at, ignoretz=True) > date)
+    columns = new_comment_columns()
+    for number, issue_type, author, body, created_at, empty in rows:
+        if number in numbers:
+            columns['author'].append(author)
+            columns['body'].append(body)
+            columns['number'].append(number)
+            columns['created_at'].append(created_at)
+            columns['type'].append(issue_type)
+            columns['empty'].append(bool(empty))
+    return columns
+
+
+def process_cached_comments(repository, date, apikey, cache_dir, refresh=False, journal=None):
+    """
+    Updates the stored comments of a repository and returns those of the issues and pull
+    requests created after date. Everything is downloaded the first time (or if refresh is
+    True), journaled if journal is given (see process_comments). Afterwards, only the issues
+    and pull requests updated since the previous run are downloaded, plus the ones created
+    before the stored period if date is older than it.
+    """
+    limiter = new_limiter(apikey)
+    download_journal = None
+    resume = journal is not None and journal[1]
+    connection = open_store(cache_dir)
+    # Comments are downloaded outside of transactions, so that the store is not locked while
+    # waiting for the API.
+    try:
+        state = None if refresh else load_store_state(connection, repository)
+        if state is None:
+            columns = new_comment_columns()
+            downloaded = {'pullRequests': set(), 'issues': set()}
+            if journal is not None:
+                download_journal = open_journal(journal, repository, date)
+                date = download_journal.date
+            try:
+                fetched = fetch_comments(
+                    repository, apikey, date, columns, downloaded, limiter=limiter,
+                    journal=download_journal)
+            finally:
+                if download_journal is not None:
+                    # Removed once the comments are stored.
+                    download_journal.close()
+            if fetched is None:
+                return None
+            before, updated_at = fetched
+            start_date = date
+            with connection:
+                connection.execute('DELETE FROM comments WHERE repository = ?', (repository,))
+                store_comments(
+                    connection, repository, columns,
+                    downloaded['pullRequests'] | downloaded['issues'])
+                save_store_state(
+                    connection, repository, start_date,
+                    updated_at or datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), before)
         else:
-            issue = False
-        if pr and last_pr is None and pr_total > downloaded_prs:
-            pr = True
-            beforePr = pr_end_cursor
+            start_date = state['start_date']
+            before = state['before']
+            updated_at = state['updated_at']
+            # Extend the stored period first, so that the issues updated since the
+            # previous run, downloaded afterwards, replace them if needed.
+            if date < start_date:
+                if len(before) > 0:
+                    columns = new_comment_columns()
+                    downloaded = {'pullRequests': set(), 'issues': set()}
+                    fetched = fetch_comments(
+                        repository, apikey, date, columns, downloaded, before=before,
+                        limiter=limiter)
+                    if fetched is None:
+                        return None
+                    before = fetched[0]
+                    # The previous high-water mark, until the refresh below is stored: the
+                    # newer issues updated since the previous run are not downloaded yet, so
+                    # the update dates of the older ones must not raise it.
+                    with connection:
+                        store_comments(
+                            connection, repository, columns,
+                            downloaded['pullRequests'] | downloaded['issues'])
+                        save_store_state(connection, repository, date, updated_at, before)
+                start_date = date
+            columns = new_comment_columns()
+            downloaded = {'pullRequests': set(), 'issues': set()}
+            fetched = fetch_comments(
+                repository, apikey, start_date, columns, downloaded, since=updated_at,
+                limiter=limiter)
+            if fetched is None:
+                return None
+            updated_at = max(filter(None, [updated_at, fetched[1]]))
+            with connection:
+                store_comments(
+                    connection, repository, columns,
+                    downloaded['pullRequests'] | downloaded['issues'])
+                save_store_state(connection, repository, start_date, updated_at, before)
+        if download_journal is not None:
+            download_journal.remove()
+        with connection:
+            columns = read_stored_comments(connection, repository, date)
+    finally:
+        connection.close()
+        # The journal of a failed download is only kept to be resumed.
+        if download_journal is not None and not resume:
+            download_journal.remove()
+    return build_comments_frame(columns)
+
+
+def load_account_states(connection, repository, key):
+    """
+    Returns the stored feature states (see account_features) of the accounts of a repository,
+    for the feature parameters identified by key.
+    """
+    import numpy as np
+    states = {}
+    for author, bodies, distances in connection.execute(
+            'SELECT author, bodies, distances FROM account_states '
+            'WHERE repository = ? AND key = ?', (repository, key)):
+        states[author] = (json.loads(bodies), np.frombuffer(distances, dtype=np.float32))
+    return states
+
+
+def save_account_states(connection, repository, key, states):
+    import numpy as np
+    connection.executemany(
+        'INSERT OR REPLACE INTO account_states VALUES (?, ?, ?, ?, ?)',
+        (
+            (
+                repository, author, key, json.dumps(bodies),
+                np.asarray(distances, dtype=np.float32).tobytes(),
+            )
+            for author, (bodies, distances) in states.items()
+        ))
+
+
+def load_predictions(connection, keys):
+    """
+    Returns the cached features and prediction (see save_predictions) of the given keys that
+    are in the store, and marks them as used.
+    """
+    keys = list(keys)
+    cached = {}
+    # SQLite limits the number of parameters of a query.
+    for start in range(0, len(keys), 500):
+        batch = keys[start:start + 500]
+        for key, features, prediction in connection.execute(
+                'SELECT key, features, prediction FROM predictions WHERE key IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch):
+            cached[key] = (tuple(json.loads(features)), prediction)
+    connection.executemany(
+        'UPDATE predictions SET accessed_at = ? WHERE key = ?',
+        ((time.time(), key) for key in cached))
+    return cached
+
+
+def save_predictions(connection, entries, size):
+    """
+    Stores the features and prediction of accounts, given by key (see prediction_key), and
+    evicts the least recently used ones beyond size. Returns the number of evicted entries.
+    """
+    now = time.time()
+    connection.executemany(
+        'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+        ((key, json.dumps(features), prediction, now)
+         for key, (features, prediction) in entries.items()))
+    count, = connection.execute('SELECT COUNT(*) FROM predictions').fetchone()
+    if count <= size:
+        return 0
+    connection.execute(
+        'DELETE FROM predictions WHERE key IN '
+        '(SELECT key FROM predictions ORDER BY accessed_at LIMIT ?)', (count - size,))
+    return count - size
+
+
+def load_account_index(connection, logins):
+    """
+    Returns the entries of the account index (see save_account_index) of the given logins that
+    are in the store, and marks them as used.
+    """
+    logins = list(logins)
+    index = {}
+    # SQLite limits the number of parameters of a query.
+    for start in range(0, len(logins), 500):
+        batch = logins[start:start + 500]
+        for login, comments, features, prediction, confidence in connection.execute(
+                'SELECT login, comments, features, prediction, confidence FROM account_index '
+                'WHERE login IN ({})'.format(', '.join('?' * len(batch))), batch):
+            features = tuple(json.loads(features)) if features is not None else None
+            index[login] = (json.loads(comments), features, prediction, confidence)
+    now = datetime.now().isoformat()
+    connection.executemany(
+        'UPDATE account_index SET accessed_at = ? WHERE login = ?',
+        ((now, login) for login in index))
+    return index
+
+
+def save_account_index(connection, entries):
+    """
+    Stores the entries of the account index, given by login as (comments, features,
+    prediction, confidence), where comments are the last (repository, created_at, body)
+    comments of the account across repositories, and features, prediction and the probability
+    of the prediction may be None if the account was not analysed.
+    """
+    now = datetime.now().isoformat()
+    connection.executemany(
+        'INSERT OR REPLACE INTO account_index VALUES (?, ?, ?, ?, ?, ?)',
+        ((login, json.dumps(comments), json.dumps(features) if features is not None else None,
+          prediction, confidence, now)
+         for login, (comments, features, prediction, confidence) in entries.items()))
+
+
+def evict_store(cache_dir, days):
+    """
+    Removes from the store the repositories that were not analysed during the last days, and
+    the accounts of the account index that were not used during the last days.
+    Returns the removed repositories.
+    """
+    from dateutil.relativedelta import relativedelta
+    connection = open_store(cache_dir)
+    try:
+        with connection:
+            limit = (datetime.now() + relativedelta(days=-days)).isoformat()
+            repositories = [row[0] for row in connection.execute(
+                'SELECT repository FROM repositories WHERE accessed_at < ?', (limit,))]
+            connection.executemany(
+                'DELETE FROM comments WHERE repository = ?', ((r,) for r in repositories))
+            connection.executemany(
+                'DELETE FROM repositories WHERE repository = ?', ((r,) for r in repositories))
+            connection.executemany(
+                'DELETE FROM account_states WHERE repository = ?', ((r,) for r in repositories))
+            connection.execute('DELETE FROM account_index WHERE accessed_at < ?', (limit,))
+        connection.execute('VACUUM')
+    finally:
+        connection.close()
+    return repositories
+
+
+# --- Comment dumps ---
+INPUT_CHUNK_SIZE = 100000
+INPUT_PARTITIONS = 64
+
+
+def dump_comment(record, repository=None):
+    """
+    Returns the comment of a dump record as a (node, number, type) tuple, with node in the
+    format of GraphQL responses (see append_comment), or None if the record is not a comment
+    of the given repository (any repository if None).
+    Records are either flat, with author, body, created_at and optional number, type and
+    repository fields, or GH Archive events, of which the comments and the opened issues and
+    pull requests are kept.
+    """
+    if 'payload' in record:
+        if repository is not None and (record.get('repo') or {}).get('name') != repository:
+            return None
+        payload = record['payload'] or {}
+        event = record.get('type')
+        if event == 'IssueCommentEvent':
+            node, issue = payload['comment'], payload['issue']
+            number = issue['number']
+            comment_type = 'pullRequests_comment' if 'pull_request' in issue else 'issues_comment'
+        elif event in ('IssuesEvent', 'PullRequestEvent') and payload.get('action') == 'opened':
+            comment_type = 'issues' if event == 'IssuesEvent' else 'pullRequests'
+            node = payload['issue' if event == 'IssuesEvent' else 'pull_request']
+            number = node['number']
         else:
-            pr = False
+            return None
+        author = (node.get('user') or {}).get('login')
+        if author is not None and author.endswith('[bot]'):
+            # The GraphQL API gives the login of apps without this suffix.
+            author = author[:-len('[bot]')]
+        body, created_at = node.get('body'), node['created_at']
+    else:
+        if repository is not None and record.get('repository', repository) != repository:
+            return None
+        author = record.get('author')
+        if isinstance(author, dict):
+            author = author.get('login')
+        number = record.get('number') or 0
+        comment_type = record.get('type') or 'issues_comment'
+        body = record.get('body')
+        created_at = record.get('created_at', record.get('createdAt'))
+    node = {
+        'author': {'login': author} if author is not None else None,
+        'body': body,
+        'createdAt': created_at,
+    }
+    return node, number, comment_type
 
-    return comments
 
+def read_dump_records(filename):
+    """
+    Yields the records of a json lines file (possibly gzipped) or of a parquet file.
+    """
+    if filename.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise BodeghaError('Reading parquet files requires pyarrow (pip install pyarrow)')
+        for batch in pyarrow.parquet.ParquetFile(filename).iter_batches():
+            yield from batch.to_pylist()
+        return
 
-def download_comments(repository, apikey, pr=True, issue=True, beforePr=None, beforeIssue=None):
-    req = Request(
-            "https://api.github.com/graphql",
-            json.dumps(
-                {
-                    "query": get_comment_search_query(repository, pr, issue, beforePr, beforeIssue)
-                }
-            ).encode('utf-8')
-        )
-    req.add_header("User-Agent", "Mozilla/5.0")
-    req.add_header("Accept", "application/json")
-    req.add_header("Content-Type", "application/json")
-    req.add_header("Authorization", "Bearer {}".format(apikey))
-    response = urlopen(req)
-    return response.read()
+    import gzip
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                raise BodeghaError('Invalid json on line {} of {}'.format(line_number, filename))
+
+
+def read_comment_dump(filename, repository, date, chunk_size=INPUT_CHUNK_SIZE):
+    """
+    Yields the comments of a dump (see read_dump_records and dump_comment) that were created
+    after date, as DataFrames of at most chunk_size comments in the format of
+    build_comments_frame.
+    """
+    try:
+        records = read_dump_records(filename)
+        columns = new_comment_columns()
+        for record in records:
+            comment = dump_comment(record, repository)
+            if comment is None:
+                continue
+            append_comment(columns, *comment)
+            if len(columns['author']) == chunk_size:
+                comments = build_comments_frame(columns)
+                yield comments[comments['created_at'] > date]
+                columns = new_comment_columns()
+    except OSError as e:
+        raise BodeghaError('Could not read the input file: {}'.format(e))
+    except (KeyError, TypeError, AttributeError) as e:
+        raise BodeghaError('Unexpected record in {} ({!r})'.format(filename, e))
+    comments = build_comments_frame(columns)
+    yield comments[comments['created_at'] > date]
+
+
+def partition_comments(chunks, directory, partitions=INPUT_PARTITIONS):
+    """
+    Appends the comments of the given chunks to partition files in directory, so that all the
+    comments of an author are in the same partition. Returns the partition files.
+    """
+    import pickle
+    import pandas
+    filenames = [
+        os.path.join(directory, 'partition{}.pickle'.format(i)) for i in range(partitions)]
+    files = {}
+    try:
+        for comments in chunks:
+            keys = pandas.util.hash_pandas_object(
+                comments['author'].astype(object), index=False) % partitions
+            for key, part in comments.groupby(keys.values):
+                if key not in files:
+                    files[key] = open(filenames[key], 'wb')
+                pickle.dump(part, files[key], protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for file in files.values():
+            file.close()
+    return [filenames[key] for key in sorted(files)]
+
+
+def read_partition(filename):
+    """
+    Returns the comments of a partition file written by partition_comments.
+    """
+    import pickle
+    import pandas
+    parts = []
+    with open(filename, 'rb') as file:
+        while True:
+            try:
+                parts.append(pickle.load(file))
+            except EOFError:
+                break
+    comments = pandas.concat(parts, ignore_index=True)
+    return comments.astype({
+        'author': 'category', 'type': pandas.CategoricalDtype(COMMENT_TYPES)})
 
 
 # --- Text process and feature production ---
@@ -262,17 +1780,83 @@ def tokenizer(text):
     return text.split(' ')
 
 
+# Number of pairs whose distances are computed at once by update_distances, which bounds the
+# size of its temporary arrays.
+CONDENSED_BLOCK = 2 ** 18
+
+
+def condensed_blocks(n, size=CONDENSED_BLOCK):
+    """
+    Yields the rows and columns of the pairs (i, j), i < j, of n items, by blocks of whole rows
+    of about size pairs, in the order of the condensed distance vector of scipy's pdist (the
+    upper triangle of the distance matrix, row by row).
+    """
+    import numpy as np
+    start = 0
+    while start < n - 1:
+        stop = start + 1
+        pairs = n - 1 - start
+        while stop < n - 1 and pairs + n - 1 - stop <= size:
+            pairs += n - 1 - stop
+            stop += 1
+        rows = np.arange(start, stop)
+        yield (
+            np.repeat(rows, n - 1 - rows),
+            np.concatenate([np.arange(i + 1, n) for i in range(start, stop)]))
+        start = stop
+
+
+def condensed_index(n, rows, columns):
+    """
+    Returns the positions of the pairs (rows, columns), rows < columns, of n items in their
+    condensed distance vector.
+    """
+    return n * rows - rows * (rows + 1) // 2 + columns - rows - 1
+
+
+def block_distances(items, distance):
+    """
+    Returns a function computing the distances between the items of given pairs (rows,
+    columns), rows being sorted and less than columns, using given distance function. The
+    pairs are given by blocks of a few distinct rows (see condensed_blocks and
+    compute_pair_distances). The jaccard distances of jaccard and average_jac_lev are computed
+    from the product of the document-term matrix of the distinct rows with the one of the
+    items from the first row on (see term_matrix), and have the same values as jaccard.
+    """
+    import numpy as np
+    items = list(items)
+    if distance not in (jaccard, average_jac_lev):
+        return lambda rows, columns: np.fromiter((
+            distance(items[i], items[j]) for i, j in zip(rows.tolist(), columns.tolist())),
+            dtype=np.float64, count=len(rows))
+    terms, sizes = term_matrix(items)
+
+    def distances(rows, columns):
+        if len(rows) == 0:
+            return np.zeros(0)
+        start = rows[0]
+        distinct, inverse = np.unique(rows, return_inverse=True)
+        intersection = (terms[distinct] @ terms[start:].T).toarray()[inverse, columns - start]
+        union = sizes[rows] + sizes[columns] - intersection
+        values = (union - intersection) / np.where(union > 0, union, 1)
+        if distance is average_jac_lev:
+            values = (values + levenshtein_pairs(items, rows, columns)) / 2
+        return values
+    return distances
+
+
 def compute_distance(items, distance):
     """
-    Computes a distance matrix for given items, using given distance function.
+    Computes the condensed distance vector of given items (see condensed_blocks), as float32
+    values, using given distance function (see block_distances).
     """
-    m = np.zeros((len(items), len(items)))
-    enumitems = list(enumerate(items))
-    for xe, ye in itertools.combinations(enumitems, 2):
-        i, x = xe
-        j, y = ye
-        d = distance(x, y)
-        m[i, j] = m[j, i] = d
+    import numpy as np
+    pairs = block_distances(items, distance)
+    m = np.empty(len(items) * (len(items) - 1) // 2, dtype=np.float32)
+    offset = 0
+    for rows, columns in condensed_blocks(len(items)):
+        m[offset:offset + len(rows)] = pairs(rows, columns)
+        offset += len(rows)
     return m
 
 
@@ -287,13 +1871,46 @@ def jaccard(x, y):
     )
 
 
+def term_matrix(items):
+    """
+    Returns the sparse binary document-term matrix of given items, each item being tokenized
+    once into a row, and the number of distinct tokens of each item.
+    """
+    import numpy as np
+    from scipy import sparse
+    vocabulary = {}
+    indices = []
+    indptr = [0]
+    for item in items:
+        indices.extend(
+            vocabulary.setdefault(token, len(vocabulary)) for token in set(tokenizer(item)))
+        indptr.append(len(indices))
+    terms = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr),
+        shape=(len(items), len(vocabulary)))
+    return terms, np.diff(indptr)
+
+
 def levenshtein(x, y, n=None):
+    from Levenshtein import distance as lev
     if n is not None:
         x = x[:n]
         y = y[:n]
     return lev(x, y) / (max(len(x), len(y)) if max(len(x), len(y)) > 0 else 1)
 
 
+def levenshtein_pairs(items, rows, columns):
+    """
+    Computes the normalized levenshtein distances between the items of given rows and columns.
+    """
+    import numpy as np
+    from Levenshtein import distance as lev
+    lengths = [len(item) for item in items]
+    return np.fromiter((
+        lev(items[i], items[j]) / (max(lengths[i], lengths[j]) or 1)
+        for i, j in zip(rows.tolist(), columns.tolist())), dtype=np.float64, count=len(rows))
+
+
 def average_jac_lev(x, y):
     """
     Computes average of jacard and levenshtein for 2 given strings
@@ -301,18 +1918,119 @@ def average_jac_lev(x, y):
     return (jaccard(x, y) + levenshtein(x, y)) / 2
 
 
-def gini(array):
-    """Calculate the Gini coefficient of a numpy array."""
+def compute_pair_distances(items, rows, columns, distance):
+    """
+    Computes the distances between the items of given pairs (rows, columns), rows being sorted
+    and less than columns, using given distance function (see block_distances), by blocks of
+    rows of about CONDENSED_BLOCK distances between their items and the others.
+    """
+    import numpy as np
+    pairs = block_distances(items, distance)
+    distinct = np.unique(rows)
+    step = max(CONDENSED_BLOCK // max(len(items), 1), 1)
+    bounds = np.searchsorted(rows, distinct[::step])
+    return np.concatenate([np.zeros(0)] + [
+        pairs(rows[start:stop], columns[start:stop])
+        for start, stop in zip(bounds, np.append(bounds[1:], len(rows)))])
+
+
+def shingles(text):
+    """
+    Returns the 32-bit hashes of the tokens and of the character trigrams of a text, so that
+    the similarity of the shingles of two texts reflects both halves of average_jac_lev.
+    """
+    import zlib
+    values = set(tokenizer(text))
+    # Trigrams are prefixed so that they are distinct from tokens of three characters.
+    values.update('\x00' + text[i:i + 3] for i in range(len(text) - 2))
+    return [zlib.crc32(value.encode('utf-8')) for value in values]
+
+
+def minhash_signatures(items, size, seed=0):
+    """
+    Returns the minhash signatures of the shingles of given items, as a matrix with a row of
+    size values per item. The hash functions are multiply-shift hashes drawn from seed, so that
+    signatures do not depend on the Python hash seed.
+    """
+    import numpy as np
+    random = np.random.RandomState(seed)
+    a = random.randint(0, 2**62, size, dtype=np.int64).astype(np.uint64) * np.uint64(2) + \
+        np.uint64(1)
+    b = random.randint(0, 2**62, size, dtype=np.int64).astype(np.uint64)
+    signatures = np.empty((len(items), size), dtype=np.uint32)
+    for i, item in enumerate(items):
+        x = np.asarray(shingles(item), dtype=np.uint64)
+        # Products wrap around modulo 2**64, the high bits are the hash values.
+        signatures[i] = ((a[:, np.newaxis] * x + b[:, np.newaxis]) >> np.uint64(32)).min(axis=1)
+    return signatures
+
+
+def lsh_candidate_pairs(signatures, bands, neighbours):
+    """
+    Returns the pairs (i, j), i < j, of items whose signatures are identical on at least one
+    of the given number of bands, as a sorted array. In a bucket, each item is only paired with
+    the next neighbours items, so that the number of pairs stays linear in the number of items
+    when many of them are near-duplicates.
+    """
+    import numpy as np
+    pairs = set()
+    for band in np.array_split(np.arange(signatures.shape[1]), bands):
+        buckets = {}
+        for i, key in enumerate(map(bytes, signatures[:, band])):
+            buckets.setdefault(key, []).append(i)
+        for members in buckets.values():
+            for k, i in enumerate(members):
+                pairs.update((i, j) for j in members[k + 1:k + 1 + neighbours])
+    return np.asarray(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+
+
+def gini(array, weights=None):
+    """Calculate the Gini coefficient of a numpy array.
+    If weights are given, each value is counted as many times as its weight, without
+    actually repeating it. Weights may be fractional, as when they are estimated."""
+    import numpy as np
     if len(array) == 0:
         return 0
-    array = array.flatten()
+    # A float64 copy, since float32 distances are compared and summed as float64 values.
+    array = np.array(array, dtype=np.float64).ravel()
     if np.amin(array) < 0:
         array -= np.amin(array)
     array += 0.0000001
-    array = np.sort(array)
-    index = np.arange(1, array.shape[0] + 1)
+    # Coefficients are computed in place, since arrays of distances may be large.
+    if weights is not None:
+        order = np.argsort(array, kind='stable')
+        array = array[order]
+        weights = np.asarray(weights).ravel()[order]
+        del order
+        n = np.sum(weights)
+        # Sum of (2 * index - n - 1) over the indexes a value would occupy once repeated,
+        # i.e., weights * (2 * start + weights - 2 - n) where start is the first index.
+        coefficients = np.cumsum(weights)
+        coefficients -= weights
+        coefficients += 1
+        coefficients *= 2
+        coefficients += weights
+        coefficients -= 2
+        coefficients -= n
+        coefficients *= weights
+        return ((np.sum(coefficients * array)) / (n * np.sum(weights * array)))
+    array.sort()
     n = array.shape[0]
-    return ((np.sum((2 * index - n - 1) * array)) / (n * np.sum(array)))
+    coefficients = np.arange(1, n + 1)
+    coefficients *= 2
+    coefficients -= n + 1
+    return ((np.sum(coefficients * array)) / (n * np.sum(array)))
+
+
+def unique_items(items):
+    """
+    Returns the distinct items, in order of first occurrence, and their number of occurrences.
+    """
+    import numpy as np
+    counts = {}
+    for item in items:
+        counts[item] = counts.get(item, 0) + 1
+    return list(counts), np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
 
 
 def count_empty_comments(comments):
@@ -324,85 +2042,411 @@ def count_empty_comments(comments):
 
 
 # --- Load model and prediction ---
-def get_model():
+FEATURES = ['comments', 'empty comments', 'patterns', 'dispersion']
+
+
+class ForestModel:
+    """
+    Array-backed random forest classifier, exported from the scikit-learn model with
+    export_model. The nodes of all trees are stored in flat arrays (roots gives the first
+    node of each tree, leaves have -1 as children), and all samples go down all trees at once.
+    Predictions are the same as the ones of the scikit-learn model.
+    """
+
+    def __init__(self, arrays):
+        import numpy as np
+        self.roots = np.asarray(arrays['roots'])
+        self.feature = np.asarray(arrays['feature'])
+        self.threshold = np.asarray(arrays['threshold'])
+        self.left = np.asarray(arrays['left'])
+        self.right = np.asarray(arrays['right'])
+        self.proba = np.asarray(arrays['proba'])
+        self.classes = np.asarray(arrays['classes'])
+
+    def predict_proba(self, X):
+        # Like scikit-learn, features are compared as float32 values.
+        import numpy as np
+        X = np.asarray(X, dtype=np.float32)
+        nodes = np.tile(self.roots, X.shape[0])
+        samples = np.repeat(np.arange(X.shape[0]), len(self.roots))
+        active = np.flatnonzero(self.left[nodes] != -1)
+        while len(active) > 0:
+            current = nodes[active]
+            go_left = X[samples[active], self.feature[current]] <= self.threshold[current]
+            nodes[active] = np.where(go_left, self.left[current], self.right[current])
+            active = active[self.left[nodes[active]] != -1]
+        nodes = nodes.reshape(X.shape[0], len(self.roots))
+        proba = np.zeros((X.shape[0], len(self.classes)))
+        # Sum tree by tree, in the same order as scikit-learn, to get the same values.
+        for tree in range(len(self.roots)):
+            proba += self.proba[nodes[:, tree]]
+        return proba / len(self.roots)
+
+    def predict(self, X):
+        import numpy as np
+        return self.classes.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+
+def export_model(source='model.json', target='model.npz', samples=100000):
+    """
+    Exports the pickled scikit-learn random forest in source to an array-backed model file
+    loaded by get_model, then checks that both models predict the same classes for random
+    samples and for values around all thresholds. Requires scikit-learn.
+    """
+    import numpy as np
+    import pandas
+    import pickle
     warnings.filterwarnings("ignore")
-    path = 'model.json'
-    filename = pkg_resources.resource_filename(__name__, path)
-    with open(filename, 'rb') as file:
+    with open(source, 'rb') as file:
         model = pickle.load(file)
 
+    roots, feature, threshold, left, right, proba = [], [], [], [], [], []
+    offset = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        leaves = tree.children_left == -1
+        roots.append(offset)
+        feature.append(np.where(leaves, 0, tree.feature))
+        threshold.append(tree.threshold)
+        left.append(np.where(leaves, -1, tree.children_left + offset))
+        right.append(np.where(leaves, -1, tree.children_right + offset))
+        value = tree.value[:, 0, :]
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        proba.append(value / normalizer)
+        offset += tree.node_count
+    arrays = {
+        'roots': np.asarray(roots, dtype=np.int32),
+        'feature': np.concatenate(feature).astype(np.int32),
+        'threshold': np.concatenate(threshold).astype(np.float64),
+        'left': np.concatenate(left).astype(np.int32),
+        'right': np.concatenate(right).astype(np.int32),
+        'proba': np.concatenate(proba).astype(np.float64),
+        'classes': np.asarray(model.classes_),
+    }
+
+    forest = ForestModel(arrays)
+    random = np.random.RandomState(0)
+    X = np.column_stack([
+        random.randint(1, 1000, samples),
+        random.randint(0, 100, samples),
+        random.randint(1, 1000, samples),
+        random.uniform(0, 1, samples),
+    ]).astype(np.float64)
+    for i in range(X.shape[1]):
+        values = arrays['threshold'][arrays['feature'] == i]
+        values = np.concatenate([
+            values, np.nextafter(values, -np.inf), np.nextafter(values, np.inf),
+            np.nextafter(values.astype(np.float32), np.float32(np.inf)).astype(np.float64)])
+        X[:len(values), i] = values
+    X = pandas.DataFrame(X, columns=FEATURES)
+    if not np.array_equal(model.predict(X), forest.predict(X)):
+        raise BodeghaError('The exported model does not predict the same classes')
+
+    np.savez(target, **arrays)
+    return forest
+
+
+def resource_filename(name):
+    """
+    Returns the path of a data file installed along with this module.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+@functools.lru_cache(maxsize=None)
+def model_version():
+    """
+    Returns a hash of the model file that get_model loads.
+    """
+    import hashlib
+    filename = resource_filename('model.npz')
+    if not os.path.exists(filename):
+        filename = resource_filename('model.json')
+    with open(filename, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def get_model():
+    """
+    Loads the array-backed model, or the pickled scikit-learn model if it is not available,
+    which requires scikit-learn.
+    """
+    import numpy as np
+    import pickle
+    with METRICS.stage('model'):
+        filename = resource_filename('model.npz')
+        if os.path.exists(filename):
+            with np.load(filename) as arrays:
+                return ForestModel(arrays)
+
+        import importlib.util
+        if importlib.util.find_spec('sklearn') is None:
+            raise BodeghaError(
+                'The model file model.npz is missing, and loading model.json instead requires '
+                'scikit-learn (pip install bodegha[export]).')
+        warnings.filterwarnings("ignore")
+        path = 'model.json'
+        filename = resource_filename(path)
+        with open(filename, 'rb') as file:
+            model = pickle.load(file)
+
     return model
 
 
 def predict(model, df):
-    df = (
-        df
-        .assign(
-            prediction=lambda x: np.where(model.predict(
-                x[['comments', 'empty comments', 'patterns', 'dispersion']]) == 1, 'Bot', 'Human')
+    import numpy as np
+    with METRICS.stage('predict'):
+        df = (
+            df
+            .assign(
+                prediction=lambda x: np.where(
+                    model.predict(x[FEATURES]) == 1, 'Bot', 'Human')
+            )
         )
-    )
+    METRICS.add('predictions', len(df))
     return df
 
 
+def predict_account(model, features):
+    """
+    Predicts the type of a single account from its features, in the order of FEATURES.
+    """
+    import numpy as np
+    X = np.asarray([features], dtype=np.float64)
+    if not isinstance(model, ForestModel):
+        import pandas
+        X = pandas.DataFrame(X, columns=FEATURES)
+    with METRICS.stage('predict'):
+        prediction = 'Bot' if model.predict(X)[0] == 1 else 'Human'
+    METRICS.add('predictions')
+    return prediction
+
+
 # --- Thread and progress ---
-def task(data):
-    author, group, max_comments, params = data
-    group = group[:max_comments]
-    clustering = DBSCAN(eps=params['eps'], min_samples=1, metric='precomputed')
-    items = compute_distance(getattr(group, params['source']), params['func'])
-    clusters = clustering.fit_predict(items)
-    empty_comments = np.count_nonzero(group['empty'])
+def update_distances(items, distance, eps, state=None):
+    """
+    Computes the condensed distance vector of given items (see compute_distance), reusing the
+    distances between the items that are in the previous state (items, distances) of an
+    account. Only the distances involving new items are computed, by blocks of
+    condensed_blocks. The pairs of items at distance at most eps are kept as links (see
+    link_pairs), and compared before their distance is rounded to float32: reused distances
+    too close to eps to be compared are computed again.
+    Returns the distances and the links.
+    """
+    import numpy as np
+    n = len(items)
+    pairs = block_distances(items, distance)
+    m = np.empty(n * (n - 1) // 2, dtype=np.float32)
+    links = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if state is not None:
+        previous_items, previous_distances = state
+        positions = {item: i for i, item in enumerate(previous_items)}
+        previous = np.asarray([positions.get(item, -1) for item in items], dtype=np.int64)
+    offset = 0
+    for rows, columns in condensed_blocks(n):
+        if state is None:
+            values = pairs(rows, columns)
+        else:
+            first, second = previous[rows], previous[columns]
+            kept = (first != -1) & (second != -1)
+            reused = previous_distances[condensed_index(
+                len(previous_items), np.minimum(first[kept], second[kept]),
+                np.maximum(first[kept], second[kept]))].astype(np.float64)
+            values = np.empty(len(rows))
+            values[kept] = reused
+            values[~kept] = pairs(rows[~kept], columns[~kept])
+            close = np.flatnonzero(kept)[np.abs(reused - eps) <= np.spacing(np.float32(eps))]
+            values[close] = pairs(rows[close], columns[close])
+        m[offset:offset + len(rows)] = values
+        offset += len(rows)
+        linked = values <= eps
+        links = link_pairs(n, links, rows[linked], columns[linked])
+    return m, links
+
+
+def pair_components(n, rows, columns):
+    """
+    Returns the connected component labels of n items linked by the given pairs of rows and
+    columns, numbered from 0 in the order of their first item. With the pairs of items at
+    distance at most eps, they are the clusters of DBSCAN with min_samples=1, without its
+    neighbourhood queries.
+    """
+    import numpy as np
+    from scipy import sparse
+    from scipy.sparse.csgraph import connected_components
+    graph = sparse.coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+
+def link_pairs(n, links, rows, columns):
+    """
+    Adds the pairs of given rows and columns to links, the rows and columns of the pairs
+    linking n items. Links are kept as a spanning forest, each item being linked to the first
+    item of its connected component, so that there are less than n of them.
+    """
+    import numpy as np
+    if len(rows) == 0:
+        return links
+    labels = pair_components(
+        n, np.concatenate([links[0], rows]), np.concatenate([links[1], columns]))
+    _, firsts = np.unique(labels, return_index=True)
+    firsts = firsts[labels]
+    linked = np.flatnonzero(firsts != np.arange(n))
+    return firsts[linked], linked
+
+
+def condensed_weights(counts):
+    """
+    Returns the condensed vector of the products of the numbers of occurrences of the items
+    of each pair (see condensed_blocks).
+    """
+    import numpy as np
+    return np.concatenate(
+        [counts[:0]] + [counts[i] * counts[i + 1:] for i in range(len(counts) - 1)])
+
+
+def account_features(bodies, counts, params, state=None):
+    """
+    Computes the patterns and dispersion features of an account from its distinct comments
+    and their number of occurrences. Identical comments are only compared once: distances are
+    computed between distinct comments, and each distance is weighted by the number of pairs
+    of comments it stands for, so that patterns and dispersion are the same as with all
+    comments.
+    If the previous state of the account (its distinct comments and their distances) is given,
+    only the distances involving comments that are not in it are computed.
+    With the lsh engine, the features of accounts having more than LSH_MIN_COMMENTS distinct
+    comments are approximated by lsh_account_features instead, and have no state.
+    Returns the features and the new state of the account.
+    """
+    import numpy as np
+    if params['engine'] == 'lsh' and len(bodies) > LSH_MIN_COMMENTS:
+        return lsh_account_features(bodies, counts, params), None
+    distances, links = update_distances(bodies, params['func'], params['eps'], state)
+    clusters = pair_components(len(bodies), *links)
+    nonzero = distances != 0
+    # Unit weights give the same coefficients as no weights.
+    weights = condensed_weights(counts)[nonzero] if np.any(counts > 1) else None
 
     return (
-        author,
-        len(group),
-        empty_comments,
         len(np.unique(clusters)),
-        gini(items[np.tril(items).astype(bool)]),
-    )
+        gini(distances[nonzero], weights),
+    ), (bodies, distances)
+
+
+# Parameters of the approximate features: LSH_BANDS bands of LSH_ROWS minhash values, each
+# distinct comment being compared with at most LSH_NEIGHBOURS others per band, and the number
+# of pairs sampled to estimate the distances of the pairs that are not compared.
+LSH_BANDS = 32
+LSH_ROWS = 3
+LSH_NEIGHBOURS = 8
+LSH_SAMPLE_PAIRS = 20000
+# Number of distinct comments above which the features of an account are approximated. With
+# benchmarks/bench_patterns.py (10 accounts), approximating is not faster below about 400
+# comments per account. It is 1.4 times faster at 600, 2.3 at 1000 and 4.1 at 2000, while
+# overestimating patterns by 2.9%, 5.3% and 11% on average (5.5%, 8.6% and 16% at most).
+LSH_MIN_COMMENTS = 500
+
+
+def lsh_account_features(bodies, counts, params):
+    """
+    Approximates the patterns and dispersion features of account_features without computing
+    the distances of all pairs of distinct comments. Pairs of near-duplicate comments are found
+    by locality-sensitive hashing of the minhash signatures of the comments, and only their
+    distances are computed: patterns are the connected components of the pairs at distance at
+    most eps. The distances of the other pairs are estimated from a uniform sample of all
+    pairs, each sampled pair standing for as many pairs as were not sampled.
+    """
+    import numpy as np
+    n = len(bodies)
+    signatures = minhash_signatures(bodies, LSH_BANDS * LSH_ROWS)
+    candidates = lsh_candidate_pairs(signatures, LSH_BANDS, LSH_NEIGHBOURS)
+    candidates = candidates[:, 0] * n + candidates[:, 1]
+
+    # Uniform sample of the pairs (i, j), i != j, keeping the ones that are not candidates.
+    random = np.random.RandomState(0)
+    first = random.randint(0, n, LSH_SAMPLE_PAIRS)
+    second = random.randint(0, n - 1, LSH_SAMPLE_PAIRS)
+    second += second >= first
+    sampled = np.minimum(first, second) * n + np.maximum(first, second)
+    sampled = sampled[~np.isin(sampled, candidates)]
+
+    # Pairs are encoded as i * n + j, and sampled pairs may occur several times.
+    pairs, inverse = np.unique(np.concatenate([candidates, sampled]), return_inverse=True)
+    distances = compute_pair_distances(bodies, pairs // n, pairs % n, params['func'])[inverse]
+    pairs = pairs[inverse]
+    rows, columns = pairs // n, pairs % n
+    weights = (counts[rows] * counts[columns]).astype(np.float64)
+    weights[len(candidates):] *= n * (n - 1) / 2 / LSH_SAMPLE_PAIRS
+
+    linked = distances <= params['eps']
+    patterns = len(np.unique(pair_components(n, rows[linked], columns[linked])))
+    nonzero = distances != 0
+    return patterns, gini(distances[nonzero], weights[nonzero])
+
+
+def task(batch, keep_state=False):
+    """
+    Computes the features of a batch of accounts given as (author, comments, empty comments,
+    distinct comments, counts, params, state) tuples, where state may be None.
+    Returns the features of each account, its new state if keep_state is True (None
+    otherwise) and the time spent computing them.
+    """
+    results = []
+    for author, comments, empty_comments, bodies, counts, params, state in batch:
+        start = time.perf_counter()
+        features, state = account_features(bodies, counts, params, state)
+        results.append((
+            (author, comments, empty_comments) + features,
+            state if keep_state else None,
+            time.perf_counter() - start))
+    return results
+
 
+def stateful_task(batch):
+    return task(batch, keep_state=True)
 
-def run_function_in_thread(pbar, function, max_value, args=[], kwargs={}):
+
+def run_function_in_thread(pbar, function, counter, args=[], kwargs={}):
+    """
+    Runs function in a thread and returns its result (None if it failed). Until it returns,
+    the progress bar shows the increase of the given metrics counter.
+    """
     ret = [None]
 
     def myrunner(function, ret, *args, **kwargs):
         ret[0] = function(*args, **kwargs)
 
+    start = METRICS.get(counter)
     thread = threading.Thread(target=myrunner, args=(function, ret) + tuple(args), kwargs=kwargs)
     thread.start()
     while thread.is_alive():
         thread.join(timeout=.1)
-        if(pbar.n < max_value - .3):
-            pbar.update(.1)
-    pbar.n = max_value
+        pbar.n = METRICS.get(counter) - start
+        pbar.refresh()
     return ret[0]
 
 
-def progress(repository, accounts, exclude, date, verbose, min_comments, max_comments, apikey, output_type, only_predicted):
-    download_progress = tqdm(
-        total=25, desc='Downloading comments', smoothing=.1,
-        bar_format='{desc}: {percentage:3.0f}%|{bar}', leave=False)
-    comments = run_function_in_thread(
-        download_progress, process_comments, 25,
-        args=[repository, accounts, date, min_comments, max_comments, apikey])
-    download_progress.close()
-
+def check_comments(comments):
     if comments is None:
         raise BodeghaError('Download failed please check stack trace and resolve the issues (401: Unauthorized means your api key is not a valid key).')
 
     if len(comments) < 1:
         raise BodeghaError('Available comments are not enough to predict the type of accounts')
 
+
+def select_comments(comments, accounts, exclude, min_comments, max_comments):
+    """
+    Keeps the last max_comments comments of each account having at least min_comments comments.
+    Comments created at the same time are kept in their order.
+    """
+    counts = count_comments(comments)
     df = (
         comments
-        [comments['author'].isin(
-            comments
-            .groupby('author', as_index=False)
-            .count()[lambda x: x['body'] >= min_comments]['author'].values
-        )]
-        .sort_values('created_at', ascending=False)
-        .groupby('author').head(max_comments)
+        [comments['author'].isin(counts.index[counts >= min_comments])]
+        .sort_values('created_at', ascending=False, kind='stable')
+        .groupby('author', observed=True).head(max_comments)
     )
 
 
@@ -412,103 +2456,997 @@ def progress(repository, accounts, exclude, date, verbose, min_comments, max_com
     if len(accounts) > 0:
         df = df[lambda x: x['author'].isin(accounts)]
 
+    return df
+
+
+FEATURE_PARAMS = {'func': average_jac_lev, 'source': 'body', 'eps': 0.5, 'engine': 'exact'}
+
+# Engines computing the patterns and dispersion features (see account_features).
+FEATURE_ENGINES = ['exact', 'lsh']
+
+
+def feature_state_key(params):
+    key = '{}:{}:{}'.format(params['func'].__name__, params['source'], params['eps'])
+    return key if params['engine'] == 'exact' else '{}:{}'.format(key, params['engine'])
+
+
+# Maximum number of accounts whose features and prediction are kept in the store.
+PREDICTION_CACHE_SIZE = 100000
+
+
+def prediction_key(bodies, params, max_comments, version):
+    """
+    Returns the key under which the features and prediction of an account are cached: a hash
+    of its selected comments, the feature parameters, max_comments and the model version.
+    """
+    import hashlib
+    digest = hashlib.sha256('{}\n{}\n{}\n'.format(
+        feature_state_key(params), max_comments, version).encode('utf-8'))
+    for body in bodies:
+        # Hashing each body separates them unambiguously.
+        digest.update(hashlib.sha256(body.encode('utf-8')).digest())
+    return digest.hexdigest()
+
+
+# Number of distances below which features are computed in the current process, since
+# starting worker processes and sending them the comments would take longer.
+MIN_PARALLEL_WORK = 5000
+
+
+def task_work(bodies, state=None, engine='exact'):
+    """
+    Returns the number of distances to compute for the given distinct comments of an account
+    (an upper bound when they are approximated by the lsh engine).
+    """
+    pairs = len(bodies) * (len(bodies) - 1) // 2
+    if engine == 'lsh' and len(bodies) > LSH_MIN_COMMENTS:
+        return min(pairs, len(bodies) * LSH_BANDS * LSH_NEIGHBOURS + LSH_SAMPLE_PAIRS)
+    if state is None:
+        return pairs
+    previous = set(state[0])
+    new = sum(1 for body in bodies if body not in previous)
+    return new * (len(bodies) - 1) - new * (new - 1) // 2
+
+
+def schedule_tasks(inputs, works, workers):
+    """
+    Splits the inputs into batches for the given number of workers. Inputs are taken from the
+    most to the least expensive, so that the longest tasks start first, and inexpensive ones
+    are grouped until their work is a fraction of the work per worker.
+    """
+    target = max(sum(works) // (4 * workers), 1)
+    batches, batch, batch_work = [], [], 0
+    for work, data in sorted(zip(works, inputs), key=lambda x: x[0], reverse=True):
+        batch.append(data)
+        batch_work += work
+        if batch_work >= target:
+            batches.append(batch)
+            batch, batch_work = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def run_tasks(pool, function, inputs, works):
+    """
+    Applies function (task or stateful_task) to the given inputs, in the pool if there is
+    enough work and several accounts, otherwise in the current process. If pool is None, a
+    pool is only created if needed. Yields the features and state of each account in order of
+    completion, and records the distances and time of each one in the metrics.
+    """
+    from tqdm import tqdm
+    from multiprocessing import Pool, cpu_count
+    parallel = len(inputs) > 1 and sum(works) >= MIN_PARALLEL_WORK
+    account_works = {data[0]: work for data, work in zip(inputs, works)}
+    progress_bar = tqdm(
+        desc='Computing features',
+        total=sum(works),
+        smoothing=.1,
+        bar_format='{desc}: {percentage:3.0f}%|{bar}',
+        leave=False)
+
+    def done(results):
+        for features, state, seconds in results:
+            work = account_works[features[0]]
+            METRICS.add('accounts')
+            METRICS.add('distance_pairs', work)
+            METRICS.record_account(features[0], seconds)
+            progress_bar.update(work)
+            yield features, state
+
+    try:
+        if not parallel:
+            for batch in schedule_tasks(inputs, works, 1):
+                yield from done(function(batch))
+            return
+        owned = pool is None
+        if owned:
+            pool = Pool()
+        try:
+            # The pool size is not public, cpu_count is its default.
+            workers = getattr(pool, '_processes', None) or cpu_count()
+            for results in pool.imap_unordered(function, schedule_tasks(inputs, works, workers)):
+                yield from done(results)
+        finally:
+            if owned:
+                pool.close()
+                pool.join()
+    finally:
+        progress_bar.close()
+
+
+def account_inputs(df, max_comments, params):
+    """
+    Returns the (author, comments, empty comments, distinct comments, counts) of each account
+    of the selected comments.
+    """
+    import numpy as np
+    accounts = []
+    for author, group in df.groupby('author', observed=True):
+        group = group[:max_comments]
+        bodies, counts = unique_items(group[params['source']])
+        accounts.append((author, len(group), np.count_nonzero(group['empty']), bodies, counts))
+    return accounts
+
+
+def stream_accounts(df, max_comments, pool, model, engine='exact'):
+    """
+    Generator computing the features of the accounts of the selected comments like
+    compute_features (without feature_cache), and yielding the features and prediction of
+    each account as a record as soon as they are computed, in order of completion.
+    """
+    params = dict(FEATURE_PARAMS, engine=engine)
+    inputs = [account + (params, None) for account in account_inputs(df, max_comments, params)]
+    works = [task_work(data[3], engine=engine) for data in inputs]
+    for (account, comments, empty_comments, patterns, dispersion), _ in run_tasks(
+            pool, task, inputs, works):
+        features = (int(comments), int(empty_comments), int(patterns), float(dispersion))
+        record = dict(zip(['account'] + FEATURES, (account,) + features))
+        record['prediction'] = predict_account(model, features)
+        yield record
+
+
+def unknown_records(comment_counts, accounts, predicted):
+    """
+    Yields the records of the accounts without prediction, as format_result adds them: the
+    accounts of comment_counts that were not predicted, then the given accounts that have no
+    comments.
+    """
+    for account, comments in comment_counts.items():
+        if account not in predicted:
+            yield dict(
+                account=account, comments=int(comments), prediction='Unknown',
+                **dict.fromkeys(['empty comments', 'patterns', 'dispersion']))
+    for identity in sorted(set(accounts) - predicted - set(comment_counts.index)):
+        yield dict(
+            account=identity, prediction='Not found',
+            **dict.fromkeys(['comments', 'empty comments', 'patterns', 'dispersion']))
+
+
+def format_record(record, columns, repository=None):
+    """
+    Returns the given account record as a json object with the given columns, written the same
+    way in every output type: counts are integers, dispersion is rounded to 10 digits (as
+    pandas' to_json does), and missing values are null.
+    """
+    import pandas
+    line = {'account': record['account']}
+    if repository is not None:
+        line['repository'] = repository
+    for column in columns:
+        value = record[column]
+        if pandas.isna(value):
+            value = None
+        elif column == 'dispersion':
+            value = round(float(value), 10)
+        elif column != 'prediction':
+            value = int(value)
+        line[column] = value
+    return json.dumps(line, separators=(',', ':'))
+
+
+def format_records(records, verbose, repository=None):
+    """
+    Yields the given account records as json lines, with the columns of format_result (see
+    format_record).
+    """
+    columns = ['prediction']
+    if verbose is True:
+        columns = ['comments', 'empty comments', 'patterns', 'dispersion', 'prediction']
+    for record in records:
+        yield format_record(record, columns, repository)
+
+
+def compute_features(df, max_comments, pool=None, feature_cache=None, engine='exact'):
+    """
+    Computes the features of each account, in the pool if given or worth it. Only the
+    distinct comments of each account and their number of occurrences are sent to workers.
+    If feature_cache is given as a (cache_dir, repository) pair, the feature states of the
+    accounts are kept in the store so that later runs only compare the new comments of each
+    account. States are not kept with the lsh engine (see account_features).
+    """
+    import pandas
+    with METRICS.stage('features'):
+        params = dict(FEATURE_PARAMS, engine=engine)
+        accounts = account_inputs(df, max_comments, params)
+
+        data = []
+        if feature_cache is None or engine != 'exact':
+            inputs = [account + (params, None) for account in accounts]
+            works = [task_work(bodies, engine=engine) for _, _, _, bodies, _ in accounts]
+            data.extend(result for result, _ in run_tasks(pool, task, inputs, works))
+        else:
+            cache_dir, repository = feature_cache
+            key = feature_state_key(params)
+            connection = open_store(cache_dir)
+            try:
+                states = load_account_states(connection, repository, key)
+                inputs = [account + (params, states.get(account[0])) for account in accounts]
+                works = [task_work(data[3], data[-1]) for data in inputs]
+                states = {}
+                for result, state in run_tasks(pool, stateful_task, inputs, works):
+                    data.append(result)
+                    states[result[0]] = state
+                with connection:
+                    save_account_states(connection, repository, key, states)
+            finally:
+                connection.close()
+
+        return pandas.DataFrame(
+            data=data, columns=['account', 'comments', 'empty comments', 'patterns', 'dispersion'])
+
+
+def count_comments(comments):
+    """
+    Returns the number of comments of each author, as a Series indexed by author, including
+    the comments that were not kept if comments come from a CommentWindows.
+    """
+    if 'author_comments' in comments:
+        return comments.groupby('author', observed=True)['author_comments'].first()
+    return comments.groupby('author', observed=True)['body'].count()
+
+
+def format_result(result, comment_counts, accounts, verbose, output_type, only_predicted,
+                  repository=None, header=True):
+    """
+    Adds the accounts without prediction if requested, with their number of comments from
+    comment_counts (see count_comments), and exports the result in the given output type.
+    When a repository is given (batch mode), it is added as the first column and json output
+    is written as one record per line. json and ndjson records are written by format_records.
+    """
+    import pandas
+    if only_predicted == True:
+        # Built from records rather than concatenated, as pandas warns about concatenating
+        # empty or all-NA frames.
+        records = result.to_dict('records')
+        records.extend(unknown_records(comment_counts, accounts, set(result['account'])))
+        result = pandas.DataFrame(records, columns=[
+            'account', 'comments', 'empty comments', 'patterns', 'dispersion', 'prediction'])
+
+    if output_type in ('json', 'ndjson'):
+        lines = format_records(result.to_dict('records'), verbose, repository)
+        if output_type == 'json' and repository is None:
+            return '[{}]'.format(','.join(lines))
+        return '\n'.join(lines)
+
+    columns = ['prediction']
+    if verbose is True:
+        columns = ['comments', 'empty comments', 'patterns', 'dispersion','prediction']
+    if repository is not None:
+        result = result.assign(repository=repository)
+        columns = ['repository'] + columns
+    result = result.set_index('account')[columns]
+
+    if output_type == 'csv':
+        return (result.to_csv(header=header))
+    else:
+        return (result)
+
+
+def analyse(comments, accounts, exclude, verbose, min_comments, max_comments, output_type,
+            only_predicted, pool=None, model=None, repository=None, header=True,
+            feature_cache=None, engine='exact', account_index=None):
+    """
+    Computes the features of the downloaded comments and predicts the type of accounts.
+    A pool and a model can be given to reuse them across repositories, otherwise the model is
+    loaded only if there is something to predict, and a pool is only created if there is
+    enough work (see run_tasks).
+    See compute_features and cached_features for feature_cache, account_features for engine,
+    and indexed_features for account_index.
+    With the ndjson output type, and neither feature_cache nor account_index, the result is a
+    generator of json lines, one per account as soon as it is predicted (see stream_accounts).
+    """
+    check_comments(comments)
+    if output_type == 'ndjson' and feature_cache is None and account_index is None:
+        df = select_comments(comments, accounts, exclude, min_comments, max_comments)
+        if len(df) > 1:
+            model = load_model(model)
+
+        def records():
+            predicted = set()
+            if len(df) > 1:
+                for record in stream_accounts(df, max_comments, pool, model, engine):
+                    predicted.add(record['account'])
+                    yield record
+            if only_predicted == True:
+                yield from unknown_records(count_comments(comments), accounts, predicted)
+
+        return format_records(records(), verbose, repository)
+
+    if account_index is not None:
+        result = indexed_features(
+            comments, accounts, exclude, min_comments, max_comments, pool, model,
+            account_index, engine)
+        return predict_result(
+            result, count_comments(comments), accounts, verbose, output_type, only_predicted,
+            model, repository, header)
+
+    df = select_comments(comments, accounts, exclude, min_comments, max_comments)
+
     if(len(df) > 1):
 #         raise BodeghaError('There are not enough comments in the selected time period to\
 # predict the type of accounts. At least 10 comments is required for each account.')
 
-        inputs = []
-        for author, group in df.groupby('author'):
-            inputs.append(
-                (
-                    author,
-                    group.copy(),
-                    max_comments,
-                    {'func': average_jac_lev, 'source': 'body', 'eps': 0.5}
-                )
-            )
+        if feature_cache is None:
+            result = compute_features(df, max_comments, pool, engine=engine)
+        else:
+            result = cached_features(df, max_comments, pool, model, feature_cache, engine)
+    else:
+        result = None
 
-        data = []
-        with Pool() as pool:
-            for result in tqdm(
-                    pool.imap_unordered(task, inputs),
-                    desc='Computing features',
-                    total=len(inputs),
-                    smoothing=.1,
-                    bar_format='{desc}: {percentage:3.0f}%|{bar}',
-                    leave=False):
-                data.append(result)
-
-        result = pandas.DataFrame(
-            data=data, columns=['account', 'comments', 'empty comments', 'patterns', 'dispersion'])
+    return predict_result(
+        result, count_comments(comments), accounts, verbose, output_type, only_predicted,
+        model, repository, header)
 
-        prediction_progress = tqdm(
-            total=25, smoothing=.1, bar_format='{desc}: {percentage:3.0f}%|{bar}', leave=False)
-        tasks = ['Loading model', 'Making prediction', 'Exporting result']
-        prediction_progress.set_description(tasks[0])
-        model = run_function_in_thread(prediction_progress, get_model, 5)
-        if model is None:
-            raise BodeghaError('Could not load the model file')
 
-        result = (
-            result
-            .assign(
-                prediction=lambda x: np.where(model.predict(
-                    x[['comments', 'empty comments', 'patterns', 'dispersion']]) == 1, 'Bot', 'Human')
-            )
-        )
-        
-        del model
+def cached_features(df, max_comments, pool, model, feature_cache, engine='exact'):
+    """
+    Computes the features of the selected comments and predicts the type of accounts, reusing
+    the features and prediction cached in the store of the accounts whose selected comments
+    did not change (see prediction_key). The other accounts are computed as compute_features
+    does with feature_cache, predicted, and cached.
+    Returns the features and prediction of all accounts.
+    """
+    import pandas
+    from tqdm import tqdm
+    cache_dir, _ = feature_cache
+    version = model_version()
+    params = dict(FEATURE_PARAMS, engine=engine)
+    keys = {
+        author: prediction_key(bodies, params, max_comments, version)
+        for author, bodies in df.groupby('author', observed=True)['body']}
+    connection = open_store(cache_dir)
+    try:
+        with connection:
+            cached = load_predictions(connection, keys.values())
+        hits = [
+            (author,) + cached[key][0] + (cached[key][1],)
+            for author, key in keys.items() if key in cached]
+        METRICS.add('prediction_cache_hits', len(hits))
+        METRICS.add('prediction_cache_misses', len(keys) - len(hits))
+
+        misses = df[~df['author'].isin([hit[0] for hit in hits])]
+        result = None
+        evicted = 0
+        if len(misses) > 0:
+            result = compute_features(misses, max_comments, pool, feature_cache, engine)
+            result = predict(load_model(model), result)
+            entries = {
+                keys[account]: (
+                    (int(comments), int(empty_comments), int(patterns), float(dispersion)),
+                    prediction)
+                for account, comments, empty_comments, patterns, dispersion, prediction
+                in result[['account'] + FEATURES + ['prediction']].itertuples(index=False)}
+            with connection:
+                evicted = save_predictions(connection, entries, PREDICTION_CACHE_SIZE)
+        METRICS.add('prediction_cache_evictions', evicted)
+    finally:
+        connection.close()
+
+    tqdm.write(
+        "Reused the features and prediction of {} of {} accounts ({} evicted from the cache)."
+        .format(len(hits), len(keys), evicted), file=sys.stderr)
+    hits = pandas.DataFrame(hits, columns=['account'] + FEATURES + ['prediction'])
+    if result is None or len(hits) == 0:
+        return hits if result is None else result
+    return pandas.concat([result, hits], ignore_index=True)
+
+
+# Minimum probability of the indexed prediction of an account for it to be answered from the
+# account index instead of being analysed again.
+INDEX_CONFIDENCE = 0.9
+
+
+def indexed_features(comments, accounts, exclude, min_comments, max_comments, pool, model,
+                     account_index, engine='exact'):
+    """
+    Computes the features and predicts the type of accounts using the account index of the
+    store, given as a (cache_dir, repository) pair, repository being the one of the comments
+    that have no repository column. The comments of the accounts are pooled with their indexed
+    comments from other repositories, and the last max_comments comments of each account are
+    its window. Accounts whose window did not change since they were indexed, and whose
+    indexed prediction has a probability of at least INDEX_CONFIDENCE, are answered from the
+    index. The other accounts are analysed from their pooled comments, and the window,
+    features and prediction of each account are stored in the index.
+    Returns the features and prediction of the accounts, or None if there are none.
+    """
+    import pandas
+    from tqdm import tqdm
+    cache_dir, repository = account_index
+    if 'repository' not in comments:
+        comments = comments.assign(repository=repository)
+    comments = comments[comments['author'].notna()]
+    if len(exclude) > 0:
+        comments = comments[~comments['author'].isin(exclude)]
+    if len(accounts) > 0:
+        comments = comments[comments['author'].isin(accounts)]
+    logins = [str(login) for login in comments['author'].unique()]
+
+    connection = open_store(cache_dir)
+    try:
+        with connection:
+            index = load_account_index(connection, logins)
+
+        indexed = pandas.DataFrame([
+            (login, body, created_at, comment_repository)
+            for login, (window, _, _, _) in index.items()
+            for comment_repository, created_at, body in window],
+            columns=['author', 'body', 'created_at', 'repository'])
+        frames = [
+            comments[['author', 'body', 'created_at', 'repository']].astype({'author': object}),
+            indexed.assign(created_at=pandas.to_datetime(indexed['created_at'])),
+        ]
+        # pandas warns about concatenating empty frames.
+        pooled = pandas.concat(
+            [frame for frame in frames if len(frame) > 0] or frames[:1], ignore_index=True,
+        ).drop_duplicates(['author', 'repository', 'created_at', 'body'])
+        pooled = pooled.assign(empty=pooled['body'].str.len() < 2)
+        windows = {
+            login: list(zip(
+                group['repository'], group['created_at'].map(lambda x: x.isoformat()),
+                group['body']))
+            for login, group in pooled.sort_values('created_at', ascending=False, kind='stable')
+            .groupby('author').head(max_comments).groupby('author')}
+
+        # An account with new comments since it was indexed is analysed again, even if its
+        # indexed prediction is confident.
+        hits = [
+            (login,) + features + (prediction,)
+            for login, (window, features, prediction, confidence) in index.items()
+            if confidence is not None and confidence >= INDEX_CONFIDENCE
+            and set(map(tuple, window)) == set(windows.get(login, []))]
+        answered = [hit[0] for hit in hits]
+        METRICS.add('account_index_hits', len(hits))
+
+        df = select_comments(
+            pooled[~pooled['author'].isin(answered)], [], [], min_comments, max_comments)
+        result = None
+        analysed = {}
+        if len(df) > 1:
+            model = load_model(model)
+            result = predict(model, compute_features(df, max_comments, pool, engine=engine))
+            confidences = model.predict_proba(result[FEATURES]).max(axis=1)
+            for row, confidence in zip(
+                    result[['account'] + FEATURES + ['prediction']].itertuples(index=False),
+                    confidences):
+                account, comment_count, empty_comments, patterns, dispersion, prediction = row
+                analysed[account] = (
+                    (int(comment_count), int(empty_comments), int(patterns), float(dispersion)),
+                    prediction, float(confidence))
+
+        entries = {}
+        for login, window in windows.items():
+            # Accounts that were not analysed keep their previous features, if any.
+            features = analysed.get(login, index.get(login, (None, None, None, None))[1:])
+            entries[login] = (window,) + features
+        with connection:
+            save_account_index(connection, entries)
+    finally:
+        connection.close()
+
+    tqdm.write(
+        'Answered {} of {} accounts from the account index.'.format(len(hits), len(logins)),
+        file=sys.stderr)
+    hits = pandas.DataFrame(hits, columns=['account'] + FEATURES + ['prediction'])
+    if result is None:
+        return hits if len(hits) > 0 else None
+    if len(hits) == 0:
+        return result
+    return pandas.concat([result, hits], ignore_index=True)
+
+
+def load_model(model=None):
+    """
+    Returns the given model, or loads it.
+    """
+    if model is not None:
+        return model
+    try:
+        return get_model()
+    except BodeghaError:
+        raise
+    except Exception as e:
+        raise BodeghaError('Could not load the model file ({})'.format(e))
+
+
+def predict_result(result, comment_counts, accounts, verbose, output_type, only_predicted,
+                   model=None, repository=None, header=True):
+    """
+    Predicts the type of the accounts whose features are given (None if there are none),
+    unless they are already predicted, and exports the result (see format_result). The model
+    is loaded if it is not given.
+    """
+    import pandas
+    if result is not None:
+        if 'prediction' not in result:
+            result = predict(load_model(model), result)
         result = result.sort_values(['prediction', 'account']).assign(patterns= lambda x: x['patterns'].astype('Int64'))
-        prediction_progress.close()
     else:
         result=pandas.DataFrame(columns = ['account', 'comments', 'empty comments', 'patterns', 'dispersion'])
 
+    return format_result(
+        result, comment_counts, accounts, verbose, output_type, only_predicted, repository,
+        header)
+
+
+def progress(repository, accounts, exclude, date, verbose, min_comments, max_comments, apikey, output_type, only_predicted,
+             cache_dir=None, refresh=False, engine='exact', account_index=False, journal=None):
+    from tqdm import tqdm
+    download_progress = tqdm(
+        desc='Downloading comments', bar_format='{desc}: {n} comments [{elapsed}]', leave=False)
+    comments = run_function_in_thread(
+        download_progress, process_comments, 'comments_parsed',
+        args=[repository, accounts, date, min_comments, max_comments, apikey, cache_dir, refresh,
+              journal])
+    download_progress.close()
+
+    return analyse(
+        comments, accounts, exclude, verbose, min_comments, max_comments, output_type,
+        only_predicted,
+        feature_cache=(cache_dir, repository) if cache_dir is not None else None,
+        engine=engine, account_index=(cache_dir, repository) if account_index else None)
+
+
+def progress_input(filename, repository, accounts, exclude, date, verbose, min_comments,
+                   max_comments, output_type, only_predicted, engine='exact'):
+    """
+    Analyses the comments of a dump file (see read_comment_dump) instead of downloading them.
+    If the dump has more than INPUT_CHUNK_SIZE comments, they are partitioned by author on
+    disk and the partitions are analysed one at a time, so that the dump does not have to fit
+    in memory.
+    """
+    import tempfile
+    import pandas
+    from tqdm import tqdm
+    from multiprocessing import Pool
+    reading_progress = tqdm(
+        desc='Reading comments', bar_format='{desc}: {n} comments [{elapsed}]', leave=False)
+
+    def read():
+        try:
+            for comments in read_comment_dump(filename, repository, date):
+                reading_progress.update(len(comments))
+                yield comments
+        finally:
+            reading_progress.close()
+
+    chunks = read()
+    first = next(chunks)
+    second = next(chunks, None)
+    if second is None:
+        return analyse(
+            first, accounts, exclude, verbose, min_comments, max_comments, output_type,
+            only_predicted, engine=engine)
+
+    if output_type == 'ndjson':
+        return format_records(stream_partitions(
+            itertools.chain([first, second], chunks), accounts, exclude, min_comments,
+            max_comments, only_predicted, engine), verbose)
+
+    with tempfile.TemporaryDirectory(prefix='bodegha-') as directory:
+        partitions = partition_comments(itertools.chain([first, second], chunks), directory)
+        features = []
+        counts = []
+        selected = 0
+        with Pool() as pool:
+            for partition in partitions:
+                comments = read_partition(partition)
+                counts.append(count_comments(comments))
+                df = select_comments(comments, accounts, exclude, min_comments, max_comments)
+                selected += len(df)
+                if len(df) > 0:
+                    features.append(compute_features(df, max_comments, pool, engine=engine))
+
+    return predict_result(
+        pandas.concat(features, ignore_index=True) if selected > 1 else None,
+        pandas.concat(counts), accounts, verbose, output_type, only_predicted)
+
+
+def stream_partitions(chunks, accounts, exclude, min_comments, max_comments, only_predicted,
+                      engine='exact'):
+    """
+    Generator partitioning the comments of the given chunks by author on disk, like
+    progress_input, and yielding the record of each account as soon as it is predicted (see
+    stream_accounts), then the ones of the accounts without prediction.
+    """
+    import tempfile
+    import pandas
+    from multiprocessing import Pool
+    model = load_model()
+    predicted = set()
+    counts = []
+    with tempfile.TemporaryDirectory(prefix='bodegha-') as directory:
+        partitions = partition_comments(chunks, directory)
+        with Pool() as pool:
+            for partition in partitions:
+                comments = read_partition(partition)
+                counts.append(count_comments(comments))
+                df = select_comments(comments, accounts, exclude, min_comments, max_comments)
+                for record in stream_accounts(df, max_comments, pool, model, engine):
+                    predicted.add(record['account'])
+                    yield record
     if only_predicted == True:
-        result = pandas.concat([result,
-            (
-                comments[lambda x: ~x['author'].isin(result['account'])][['author','body']]
-                .groupby('author', as_index=False)
-                .count()
-                .assign(
-                    emptycomments=np.nan,
-                    patterns=np.nan,
-                    dispersion=np.nan,
-                    prediction="Unknown",
-                )
-                .rename(columns={'author':'account','body':'comments','emptycomments':'empty comments'})
-            )],ignore_index=True,sort=True)
-
-        for identity in (set(accounts) - set(result['account'])):
-            result = pandas.concat([result, {
-                'account': identity,
-                'comments':np.nan,
-                'empty comments':np.nan,
-                'patterns':np.nan,
-                'dispersion':np.nan,
-                'prediction':"Not found",
-            }],ignore_index=True,sort=True)
-
-    if verbose is False:
-        result = result.set_index('account')[['prediction']]
-    else:
-        result = (
-            result
-            .set_index('account')
-            [['comments', 'empty comments', 'patterns', 'dispersion','prediction']]
-        )
+        yield from unknown_records(pandas.concat(counts), accounts, predicted)
+
+
+def progress_many(repositories, accounts, exclude, date, verbose, min_comments, max_comments, apikey, output_type, only_predicted,
+                  cache_dir=None, refresh=False, engine='exact', account_index=False,
+                  journal=None):
+    """
+    Generator analysing several repositories with a single model load and a single pool.
+    The comments of the next repository are downloaded while the features of the current
+    one are computed. It yields a (repository, result) pair as soon as a repository is done,
+    where result is a BodeghaError if the repository could not be analysed.
+    If account_index is True, the account index of the store in cache_dir is used (see
+    indexed_features).
+    """
+    from multiprocessing import Pool
+    from concurrent.futures import ThreadPoolExecutor
+    repositories = list(repositories)
+    if len(repositories) == 0:
+        return
 
-    if output_type == 'json':
-        return (result.reset_index().to_json(orient='records'))
-    elif output_type == 'csv':
-        return (result.to_csv())
+    with ThreadPoolExecutor(max_workers=1) as downloader, Pool() as pool:
+        def download(repository):
+            return downloader.submit(
+                process_comments, repository, accounts, date, min_comments, max_comments, apikey,
+                cache_dir, refresh, journal)
+
+        pending = download(repositories[0])
+        model = get_model()
+        header = True
+        for index, repository in enumerate(repositories):
+            try:
+                comments = pending.result()
+            except BodeghaError as e:
+                comments = e
+            except Exception as e:
+                comments = BodeghaError('Download failed ({}).'.format(e))
+            if index + 1 < len(repositories):
+                pending = download(repositories[index + 1])
+
+            if isinstance(comments, BodeghaError):
+                yield repository, comments
+                continue
+            try:
+                yield repository, analyse(
+                    comments, accounts, exclude, verbose, min_comments, max_comments,
+                    output_type, only_predicted, pool=pool, model=model,
+                    repository=repository, header=header,
+                    feature_cache=(cache_dir, repository) if cache_dir is not None else None,
+                    engine=engine,
+                    account_index=(cache_dir, repository) if account_index else None)
+                header = False
+            except BodeghaError as e:
+                yield repository, e
+
+
+def progress_org(repositories, accounts, exclude, date, verbose, min_comments, max_comments,
+                 apikey, output_type, only_predicted, cache_dir=None, refresh=False,
+                 engine='exact', account_index=False, journal=None):
+    """
+    Analyses the accounts of several repositories at once: the comments of each account are
+    pooled across the repositories before its last max_comments comments are selected, so
+    that the features of each account are computed once. Repositories whose comments could
+    not be downloaded are reported on stderr and skipped.
+    If account_index is True, the account index of the store in cache_dir is used as well
+    (see indexed_features).
+    """
+    import numpy as np
+    import pandas
+    from tqdm import tqdm
+    frames = []
+    counts = []
+    for repository in repositories:
+        download_progress = tqdm(
+            desc='Downloading {}'.format(repository),
+            bar_format='{desc}: {n} comments [{elapsed}]', leave=False)
+        comments = run_function_in_thread(
+            download_progress, process_comments, 'comments_parsed',
+            args=[repository, accounts, date, min_comments, max_comments, apikey, cache_dir,
+                  refresh, journal])
+        download_progress.close()
+        if comments is None:
+            tqdm.write('{}: Download failed.'.format(repository), file=sys.stderr)
+            continue
+        counts.append(count_comments(comments))
+        frames.append(
+            comments.drop(columns='author_comments', errors='ignore')
+            .assign(repository=repository))
+    if len(frames) == 0:
+        check_comments(None)
+
+    # Repositories without comments are left out, as pandas warns about concatenating empty
+    # frames.
+    comments = pandas.concat(
+        [frame for frame in frames if len(frame) > 0] or frames[:1], ignore_index=True)
+    comments['author'] = comments['author'].astype('category')
+    # The number of comments of each account, in all repositories.
+    counts = pandas.concat(
+        [count for count in counts if len(count) > 0] or counts[:1]
+    ).groupby(level=0, observed=True).sum()
+    comments['author_comments'] = (
+        comments['author'].astype(object).map(counts).fillna(0).astype(np.int64))
+
+    return analyse(
+        comments, accounts, exclude, verbose, min_comments, max_comments, output_type,
+        only_predicted, engine=engine,
+        account_index=(cache_dir, None) if account_index else None)
+
+
+# --- Prediction service ---
+class PredictionService:
+    """
+    Keeps the model and a pool of workers warm to answer prediction requests. Requests are
+    queued and run by a fixed number of threads, and concurrent requests with the same
+    parameters share a single analysis. With a store (cache_dir), requests for the same
+    repository with other parameters download its comments one after the other, so that the
+    later ones only download the comments posted since; without a store, each of them
+    downloads all the comments it needs.
+    """
+
+    def __init__(self, apikey, cache_dir=None, processes=None, concurrency=2):
+        from multiprocessing import Pool
+        from concurrent.futures import ThreadPoolExecutor
+        self.apikey = apikey
+        self.cache_dir = cache_dir
+        self.model = get_model()
+        self.pool = Pool(processes)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.lock = threading.Lock()
+        self.running = {}
+        # The download lock of each repository, and the number of requests using it.
+        self.downloads = {}
+
+    def submit(self, repository, accounts=(), exclude=(), start_date=None, verbose=False,
+               min_comments=10, max_comments=100, output_type='json', only_predicted=True):
+        """
+        Returns a future of the result progress would give for these parameters.
+        """
+        key = (
+            repository, tuple(sorted(accounts)), tuple(sorted(exclude)), start_date, verbose,
+            min_comments, max_comments, output_type, only_predicted)
+        with self.lock:
+            future = self.running.get(key)
+            if future is not None:
+                return future
+            future = self.executor.submit(self.run, *key)
+            self.running[key] = future
+        # Outside of the lock, since a future that is already done runs the callback at once.
+        future.add_done_callback(lambda _: self.forget(key, future))
+        return future
+
+    def forget(self, key, future):
+        with self.lock:
+            if self.running.get(key) is future:
+                del self.running[key]
+
+    def download_lock(self, repository):
+        """
+        Returns the download lock of repository, to be given back with release_download.
+        """
+        with self.lock:
+            entry = self.downloads.setdefault(repository, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def release_download(self, repository):
+        """
+        Removes the download lock of repository once no request uses it.
+        """
+        with self.lock:
+            entry = self.downloads[repository]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.downloads[repository]
+
+    def run(self, repository, accounts, exclude, start_date, verbose, min_comments,
+            max_comments, output_type, only_predicted):
+        if min_comments > max_comments:
+            raise BodeghaError(
+                'The minimum number of comments should be less than the maximum number of comments.')
+        if start_date is not None:
+            import dateutil.parser
+            try:
+                date = dateutil.parser.parse(start_date)
+            except (ValueError, OverflowError):
+                raise BodeghaError('Invalid start date: {}'.format(start_date))
+        else:
+            from dateutil.relativedelta import relativedelta
+            date = datetime.now()+relativedelta(months=-6)
+        accounts, exclude = list(accounts), list(exclude)
+
+        try:
+            if self.cache_dir is None:
+                comments = process_comments(
+                    repository, accounts, date, min_comments, max_comments, self.apikey)
+            else:
+                # Requests for the same repository with other parameters wait for each
+                # other's download, and then read the stored comments, only downloading the
+                # ones posted since.
+                download_lock = self.download_lock(repository)
+                try:
+                    with download_lock:
+                        comments = process_comments(
+                            repository, accounts, date, min_comments, max_comments,
+                            self.apikey, self.cache_dir)
+                finally:
+                    self.release_download(repository)
+        except BodeghaError:
+            raise
+        except Exception as e:
+            raise BodeghaError('Download failed ({}).'.format(e))
+        return analyse(
+            comments, accounts, exclude, verbose, min_comments, max_comments, output_type,
+            only_predicted, pool=self.pool, model=self.model,
+            feature_cache=(self.cache_dir, repository) if self.cache_dir is not None else None)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+        self.pool.join()
+
+
+def make_request_handler(service):
+    """
+    Returns the HTTP request handler of the prediction service. Predictions are requested with
+    GET /predict?repository=owner/repo and optional accounts, exclude (comma-separated or
+    repeated), start_date, min_comments, max_comments, verbose, only_predicted and format
+    (json, csv or text) parameters, with the same meaning as the command line options.
+    """
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlsplit, parse_qs
+
+    flag = ('1', 'true', 'yes', '')
+    content_types = {
+        'json': 'application/json', 'csv': 'text/csv', 'text': 'text/plain'}
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        server_version = 'BoDeGHa'
+
+        def address_string(self):
+            # Unix sockets have no client address.
+            return self.client_address[0] if self.client_address else 'local'
+
+        def send(self, code, body, content_type='text/plain'):
+            body = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', '{}; charset=utf-8'.format(content_type))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/health':
+                return self.send(200, 'ok\n')
+            if url.path == '/metrics':
+                return self.send(200, METRICS.prometheus(), 'text/plain; version=0.0.4')
+            if url.path != '/predict':
+                return self.send(404, 'Not found\n')
+
+            query = parse_qs(url.query, keep_blank_values=True)
+
+            def values(name):
+                return [v for value in query.get(name, []) for v in value.split(',') if v]
+
+            def value(name, default=None):
+                return query[name][-1] if name in query else default
+
+            try:
+                repository = value('repository')
+                if repository is None or repository.count('/') != 1:
+                    raise BodeghaError('A repository ("owner/repo") is required')
+                output_type = value('format', 'json')
+                if output_type not in content_types:
+                    raise BodeghaError('Unknown format: {}'.format(output_type))
+                try:
+                    min_comments = int(value('min_comments', 10))
+                    max_comments = int(value('max_comments', 100))
+                except ValueError:
+                    raise BodeghaError('min_comments and max_comments must be integers')
+                result = service.submit(
+                    repository,
+                    accounts=values('accounts'),
+                    exclude=values('exclude'),
+                    start_date=value('start_date'),
+                    verbose=value('verbose', 'false').lower() in flag,
+                    min_comments=min_comments,
+                    max_comments=max_comments,
+                    output_type=output_type,
+                    # Same meaning as --only-predicted: only list predicted accounts.
+                    only_predicted=value('only_predicted', 'false').lower() not in flag,
+                ).result()
+            except BodeghaError as e:
+                return self.send(400, '{}\n'.format(e))
+            except Exception as e:
+                return self.send(500, '{}\n'.format(e))
+
+            if output_type == 'text':
+                import pandas
+                with pandas.option_context(
+                        'display.max_rows', None, 'display.max_columns', None):
+                    result = '{}\n'.format(result)
+            self.send(200, result, content_types[output_type])
+
+    return RequestHandler
+
+
+def serve(apikey, host='127.0.0.1', port=8000, socket=None, cache_dir=None, processes=None,
+          concurrency=2):
+    """
+    Runs the prediction service over HTTP, on the given host and port or on a Unix socket,
+    until it is interrupted.
+    """
+    from http.server import ThreadingHTTPServer
+    import socketserver
+
+    # The feature times of the accounts of all requests would only grow.
+    METRICS.keep_accounts = False
+    service = PredictionService(apikey, cache_dir, processes, concurrency)
+    handler = make_request_handler(service)
+    if socket is not None:
+        class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(socket):
+            os.remove(socket)
+        server = UnixHTTPServer(socket, handler)
+        address = socket
     else:
-        return (result)
+        server = ThreadingHTTPServer((host, port), handler)
+        address = 'http://{}:{}'.format(*server.server_address[:2])
+    print('Serving predictions on {}'.format(address), file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socket is not None and os.path.exists(socket):
+            os.remove(socket)
 
 
 # --- cli ---
 def arg_parser():
     parser = argparse.ArgumentParser(description='BoDeGHa - Bot detection in Github')
-    parser.add_argument('repository', help='Name of a repository on GitHub ("owner/repo")')
+    parser.add_argument(
+        'repository', nargs='?', default=None,
+        help='Name of a repository on GitHub ("owner/repo")')
+    parser.add_argument(
+        '--repos-file', metavar='FILE', required=False, default=None, type=str,
+        help='File with the names of several repositories ("owner/repo"), one per line, \
+to be analysed in a single run')
+    parser.add_argument(
+        '--org-wide', action='store_true', required=False, default=False,
+        help='Pool the comments of each account across the repositories of --repos-file and \
+analyse each account once, instead of analysing each repository')
+    parser.add_argument(
+        '--input', metavar='FILE', required=False, default=None, type=str,
+        help='Analyse the comments of a dump (json lines, possibly gzipped, or parquet) instead \
+of downloading them. Records are either GH Archive events or have author, body and created_at \
+fields. If a repository is given, only its comments are analysed')
     parser.add_argument(
         '--accounts', metavar='ACCOUNT', required=False, default=list(), type=str, nargs='*',
         help='User login of one or more accounts. Example: \
@@ -531,26 +3469,189 @@ def arg_parser():
         '--max-comments', type=int, required=False, default=100,
         help='Maximum number of comments to be used (default=100)')
     parser.add_argument(
-        '--key', metavar='APIKEY', required=True, type=str, default='',
-        help='GitHub APIv4 key to download comments from GitHub GraphQL API')
+        '--patterns-engine', choices=FEATURE_ENGINES, required=False, default='exact',
+        help='How the comment patterns are detected: exact compares all pairs of comments, lsh \
+only compares near-duplicates found by locality-sensitive hashing and approximates the features \
+of accounts with more than 500 distinct comments. With 10 accounts, lsh is 1.4 times faster \
+at 600 comments per account and 4 times at 2000, and overestimates patterns by 3%% and 11%% \
+on average (default=exact)')
+    parser.add_argument(
+        '--key', metavar='APIKEY', required=False, type=str, default='',
+        help='GitHub APIv4 key to download comments from GitHub GraphQL API \
+(required unless --input, --keys-file or the {} environment variable is given)'.format(
+            KEYS_VARIABLE))
+    parser.add_argument(
+        '--keys-file', metavar='FILE', required=False, default=None, type=str,
+        help='File with several GitHub APIv4 keys, one per line, to spread the requests over \
+their rate limits')
     parser.add_argument(
         '--only-predicted', action="store_false", required=False, default=True,
         help='Only list accounts that the prediction is available.')
     
+    parser.add_argument(
+        '--cache-dir', metavar='DIR', required=False, default=None, type=str,
+        help='Directory where downloaded comments are stored, so that later runs only download \
+the issues and pull requests updated in the meantime')
+    parser.add_argument(
+        '--refresh', action="store_true", required=False, default=False,
+        help='Download all comments again instead of updating the stored ones \
+(requires --cache-dir)')
+    parser.add_argument(
+        '--resume', action="store_true", required=False, default=False,
+        help='Journal the download of the comments in --cache-dir, or in ~/.cache/bodegha, and \
+resume the interrupted download of a previous run with --resume from its journal instead of \
+starting it again')
+    parser.add_argument(
+        '--account-index', action="store_true", required=False, default=False,
+        help='Keep the comments, features and prediction of each account across repositories in \
+the store, answer the accounts that are confidently classified from it, and pool the comments \
+of the other ones with their comments in other repositories (requires --cache-dir)')
+    parser.add_argument(
+        '--metrics-file', metavar='FILE', required=False, default=None, type=str,
+        help='Write the metrics of the run (requests, bytes received, rate limit cost, comments, \
+distances, time spent in each stage and for each account) to FILE as json')
+    parser.add_argument(
+        '--prometheus-file', metavar='FILE', required=False, default=None, type=str,
+        help='Write the metrics of the run to FILE in the Prometheus text format')
+    parser.add_argument(
+        '--evict-days', metavar='DAYS', type=int, required=False, default=None,
+        help='Remove from the cache the repositories that were not analysed during the last DAYS \
+days (requires --cache-dir)')
+
     group2 = parser.add_mutually_exclusive_group()
     group2.add_argument('--text', action='store_true', help='Print results as text.')
     group2.add_argument('--csv', action='store_true', help='Print results as csv.')
     group2.add_argument('--json', action='store_true', help='Print results as json.')
+    group2.add_argument(
+        '--ndjson', action='store_true',
+        help='Print results as json lines, each account being printed as soon as it is predicted.')
+
+    args = parser.parse_args()
+    if args.input is not None:
+        if args.repos_file is not None or args.cache_dir is not None or args.resume:
+            parser.error('--input cannot be used with --repos-file, --cache-dir or --resume')
+    elif (args.repository is None) == (args.repos_file is None):
+        parser.error('either a repository, --repos-file or --input is required')
+    if args.cache_dir is None and (
+            args.refresh or args.evict_days is not None or args.account_index):
+        parser.error('--refresh, --evict-days and --account-index require --cache-dir')
+    if args.org_wide and args.repos_file is None:
+        parser.error('--org-wide requires --repos-file')
+    return args
+
+
+def serve_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='bodegha serve',
+        description='BoDeGHa - Bot detection in Github, as a local prediction service')
+    parser.add_argument(
+        '--key', metavar='APIKEY', required=False, type=str, default='',
+        help='GitHub APIv4 key to download comments from GitHub GraphQL API')
+    parser.add_argument(
+        '--keys-file', metavar='FILE', required=False, default=None, type=str,
+        help='File with several GitHub APIv4 keys, one per line, to spread the requests over \
+their rate limits')
+    parser.add_argument(
+        '--host', type=str, required=False, default='127.0.0.1',
+        help='Address to listen on (default=127.0.0.1)')
+    parser.add_argument(
+        '--port', type=int, required=False, default=8000,
+        help='Port to listen on (default=8000)')
+    parser.add_argument(
+        '--socket', metavar='PATH', type=str, required=False, default=None,
+        help='Listen on a Unix socket instead of a TCP port')
+    parser.add_argument(
+        '--cache-dir', metavar='DIR', required=False, default=None, type=str,
+        help='Directory where downloaded comments are stored between requests')
+    parser.add_argument(
+        '--processes', type=int, required=False, default=None,
+        help='Number of processes computing features (default=number of CPUs)')
+    parser.add_argument(
+        '--concurrency', type=int, required=False, default=2,
+        help='Number of requests analysed at the same time, the others are queued (default=2)')
+
+    args = parser.parse_args(sys.argv[2:])
+    try:
+        args.apikey = get_apikey(args.key, args.keys_file)
+    except BodeghaError as e:
+        parser.error(str(e))
+    if args.apikey is None:
+        parser.error('A GitHub personal access token is required to start the process. \
+Please read more about it in the repository readme file.')
+    if args.concurrency < 1 or (args.processes is not None and args.processes < 1):
+        parser.error('--processes and --concurrency must be positive')
+    return args
 
-    return parser.parse_args()
+
+def read_repositories(filename):
+    """
+    Reads repository names from a file, skipping empty lines and lines starting with #.
+    """
+    try:
+        with open(filename) as file:
+            lines = [line.strip() for line in file]
+    except OSError as e:
+        raise BodeghaError('Could not read the repositories file: {}'.format(e))
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def read_keys(filename):
+    """
+    Reads API keys from a file, one per line, skipping empty lines and lines starting with #.
+    """
+    try:
+        with open(filename) as file:
+            lines = [line.strip() for line in file]
+    except OSError as e:
+        raise BodeghaError('Could not read the keys file: {}'.format(e))
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def get_apikey(key, keys_file=None):
+    """
+    Returns the API key given with --key, or a KeyPool if several keys are given with --key
+    and --keys-file, or with the KEYS_VARIABLE environment variable (separated by commas or
+    whitespace) if neither is given. Returns None if there is no valid key.
+    """
+    keys = [key] if key != '' else []
+    if keys_file is not None:
+        keys.extend(read_keys(keys_file))
+    if len(keys) == 0:
+        keys = os.environ.get(KEYS_VARIABLE, '').replace(',', ' ').split()
+    # Without duplicates, which would share a rate limit.
+    keys = [key for index, key in enumerate(keys) if key not in keys[:index]]
+    if len(keys) == 0 or any(len(key) < 35 for key in keys):
+        return None
+    return keys[0] if len(keys) == 1 else KeyPool(keys)
+
+
+def print_result(result):
+    import pandas
+    if not isinstance(result, (str, pandas.DataFrame)):
+        # Json lines generated as accounts are predicted.
+        for line in result:
+            print(line, flush=True)
+        return
+    with pandas.option_context('display.max_rows', None, 'display.max_columns', None):
+        print(result, flush=True)
 
 
 def cli():
+    if sys.argv[1:2] == ['serve']:
+        args = serve_arg_parser()
+        serve(
+            args.apikey, args.host, args.port, args.socket, args.cache_dir, args.processes,
+            args.concurrency)
+        return
+
     args = arg_parser()
 
-    date = datetime.now()+relativedelta(months=-6)
     if args.start_date is not None:
+        import dateutil.parser
         date = dateutil.parser.parse(args.start_date)
+    else:
+        from dateutil.relativedelta import relativedelta
+        date = datetime.now()+relativedelta(months=-6)
 
     if args.min_comments > args.max_comments:
         sys.exit('The minimum number of comments should be less than the maximum number of comments.')
@@ -558,22 +3659,108 @@ def cli():
         min_comments = args.min_comments
         max_comments = args.max_comments
 
-    if args.key == '' or len(args.key) < 35:
+    try:
+        apikey = get_apikey(args.key, args.keys_file)
+    except BodeghaError as e:
+        sys.exit(str(e))
+    if args.input is None and apikey is None:
         sys.exit('A GitHub personal access token is required to start the process. \
 Please read more about it in the repository readme file.')
-    else:
-        apikey = args.key
+
+    # Downloads are only journaled to be resumed.
+    journal = (args.cache_dir or JOURNAL_DIR, True) if args.resume else None
 
     if args.csv:
         output_type = 'csv'
     elif args.json:
         output_type = 'json'
+    elif args.ndjson:
+        output_type = 'ndjson'
     else:
         output_type = 'text'
 
     try:
-        with pandas.option_context('display.max_rows', None, 'display.max_columns', None):
-            print(
+        if args.evict_days is not None:
+            evict_store(args.cache_dir, args.evict_days)
+
+        if args.input is not None:
+            try:
+                print_result(
+                    progress_input(
+                        args.input,
+                        args.repository,
+                        args.accounts,
+                        args.exclude,
+                        date,
+                        args.verbose,
+                        min_comments,
+                        max_comments,
+                        output_type,
+                        args.only_predicted,
+                        args.patterns_engine,
+                    ))
+            except BodeghaError as e:
+                sys.exit(e)
+            return
+
+        if args.repos_file is not None:
+            try:
+                repositories = read_repositories(args.repos_file)
+            except BodeghaError as e:
+                sys.exit(e)
+            if args.org_wide:
+                try:
+                    print_result(
+                        progress_org(
+                            repositories,
+                            args.accounts,
+                            args.exclude,
+                            date,
+                            args.verbose,
+                            min_comments,
+                            max_comments,
+                            apikey,
+                            output_type,
+                            args.only_predicted,
+                            args.cache_dir,
+                            args.refresh,
+                            args.patterns_engine,
+                            args.account_index,
+                            journal,
+                        ))
+                except BodeghaError as e:
+                    sys.exit(e)
+                return
+            failed = False
+            for repository, result in progress_many(
+                    repositories,
+                    args.accounts,
+                    args.exclude,
+                    date,
+                    args.verbose,
+                    min_comments,
+                    max_comments,
+                    apikey,
+                    output_type,
+                    args.only_predicted,
+                    args.cache_dir,
+                    args.refresh,
+                    args.patterns_engine,
+                    args.account_index,
+                    journal,
+                    ):
+                if isinstance(result, BodeghaError):
+                    from tqdm import tqdm
+                    failed = True
+                    tqdm.write('{}: {}'.format(repository, result), file=sys.stderr)
+                else:
+                    print_result(result)
+            if failed:
+                sys.exit(1)
+            return
+
+        try:
+            print_result(
                 progress(
                     args.repository,
                     args.accounts,
@@ -585,9 +3772,19 @@ Please read more about it in the repository readme file.')
                     apikey,
                     output_type,
                     args.only_predicted,
+                    args.cache_dir,
+                    args.refresh,
+                    args.patterns_engine,
+                    args.account_index,
+                    journal,
                 ))
-    except BodeghaError as e:
-        sys.exit(e)
+        except BodeghaError as e:
+            sys.exit(e)
+    finally:
+        if args.metrics_file is not None:
+            METRICS.write(args.metrics_file)
+        if args.prometheus_file is not None:
+            METRICS.write(args.prometheus_file, prometheus=True)
 
 
 if __name__ == '__main__':
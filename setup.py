@@ -22,21 +22,20 @@ __classifiers__=[
         'Intended Audience :: Science/Research',
         'Topic :: Scientific/Engineering :: Information Analysis',
         'License :: OSI Approved :: GNU Lesser General Public License v3 (LGPLv3)',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
-        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ]
 __requirement__ = [
         'python-dateutil >= 2.7.5',
-        'pandas >= 0.23.4',
-        'scikit-learn == 1.0.1',
+        'pandas >= 2.2.1',
         'argparse >= 1.1',
         'tqdm >= 4.41.1',
         'urllib3 >= 1.25',
         'python-levenshtein >= 0.12.2',
-        'numpy >= 1.17.4',
+        'numpy >= 1.26.4',
+        'scipy >= 1.1.0',
 ]
 
 setup(
@@ -58,8 +57,16 @@ setup(
 
     keywords='github bot account comment',
 
+    python_requires = '>=3.9',
+
     install_requires = __requirement__,
 
+    extras_require = {
+        'parquet': ['pyarrow >= 1.0.0'],
+        # To export the pickled model (model.json) to model.npz, see export_model.
+        'export': ['scikit-learn >= 1.0.1'],
+    },
+
     include_package_data = True,
     packages = ['.'],
 
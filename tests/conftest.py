@@ -0,0 +1,23 @@
+#  Fixtures of the tests of bodegha.py
+
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+from stub_graphql import StubServer  # noqa: E402
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """
+    A StubServer that the GraphQL requests of bodegha are sent to, through a new transport.
+    """
+    server = StubServer()
+    monkeypatch.setattr(bodegha, 'GRAPHQL_URL', server.url)
+    monkeypatch.setattr(bodegha, 'TRANSPORT', bodegha.HTTPTransport(timeout=30))
+    yield server
+    server.close()
@@ -0,0 +1,262 @@
+#  Local stub of the GitHub GraphQL API, serving the pull requests and issues of synthetic
+#  repositories as the download functions of bodegha.py query them: pages of the last 100
+#  issues before a cursor, ordered by creation or update date, with their first 100
+#  comments, and the next comments of long threads by node id. Responses can be made to fail
+#  with given status codes and headers, for all requests or for the requests of an API key.
+
+
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+BOTS = {
+    'ci-bot': ['Build {} passed', 'Build {} failed, see the logs'],
+    'codecov': ['Coverage remains the same at {}%', 'Coverage increased (+0.1%) to {}%'],
+}
+WORDS = 'the a fix bug issue please thanks merge review looks good to me lgtm code test'.split()
+
+
+def make_repository(seed=0, pulls=250, issues=230, humans=20, long_threads=0.0,
+                    start=datetime(2024, 1, 1)):
+    """
+    Returns the pull requests and issues of a synthetic repository, created every few hours
+    from start, with comments of bots, humans and deleted accounts (None). A long_threads
+    fraction of them have more than 100 comments.
+    """
+    rnd = random.Random(seed)
+    logins = ['user{}'.format(i) for i in range(humans)]
+
+    def author():
+        r = rnd.random()
+        if r < 0.02:
+            return None
+        return rnd.choice(list(BOTS)) if r < 0.3 else rnd.choice(logins)
+
+    def body(login):
+        if login in BOTS:
+            return rnd.choice(BOTS[login]).format(rnd.randint(1, 9))
+        if rnd.random() < 0.05:
+            return rnd.choice(['', '+1', 'x'])
+        return ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 20)))
+
+    repository = {}
+    for index, (issue_type, count) in enumerate([('pullRequests', pulls), ('issues', issues)]):
+        items = []
+        for i in range(count):
+            created = start + timedelta(hours=7 * i + rnd.randint(0, 5))
+            size = rnd.randint(101, 250) if rnd.random() < long_threads else rnd.randint(0, 12)
+            comments = []
+            for k in range(size):
+                login = author()
+                comments.append(
+                    comment(login, body(login), created + timedelta(minutes=13 * k + 1)))
+            login = author()
+            items.append({
+                'id': '{}_{}'.format(issue_type, i),
+                'number': 2 * i + index,
+                'author': {'login': login} if login is not None else None,
+                'body': body(login),
+                'createdAt': timestamp(created),
+                'updatedAt': comments[-1]['createdAt'] if comments else timestamp(created),
+                'comments': comments,
+            })
+        repository[issue_type] = items
+    return repository
+
+
+def timestamp(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def comment(login, body, created):
+    return {
+        'author': {'login': login} if login is not None else None,
+        'body': body,
+        'createdAt': timestamp(created),
+    }
+
+
+def add_comment(repository, issue_type, index, login, body, created):
+    """
+    Adds a comment to an issue (or pull request), which updates it.
+    """
+    item = repository[issue_type][index]
+    item['comments'].append(comment(login, body, created))
+    item['updatedAt'] = timestamp(created)
+
+
+def add_issue(repository, issue_type, login, body, created):
+    """
+    Adds an issue (or pull request) without comments, created after the other ones.
+    """
+    items = repository[issue_type]
+    items.append({
+        'id': '{}_{}'.format(issue_type, len(items)),
+        'number': max(item['number'] for item in items) + 2,
+        'author': {'login': login} if login is not None else None,
+        'body': body,
+        'createdAt': timestamp(created),
+        'updatedAt': timestamp(created),
+        'comments': [],
+    })
+
+
+def expected_comments(repository, date):
+    """
+    Returns the (author, body, number, created_at, type) comments of the issues and pull
+    requests of a repository created after date, as the download functions give them.
+    """
+    comments = []
+    for issue_type, items in repository.items():
+        for item in items:
+            if item['createdAt'] <= timestamp(date):
+                continue
+            for node, comment_type in [(item, issue_type)] + [
+                    (node, issue_type + '_comment') for node in item['comments']]:
+                comments.append((
+                    node['author']['login'] if node['author'] is not None else None,
+                    node['body'] or '', item['number'], node['createdAt'], comment_type))
+    return comments
+
+
+def page(items, before, order):
+    """
+    Returns the connection of the last 100 items before the given cursor, the cursor of an
+    item being its position in order.
+    """
+    if order == 'UPDATED_AT':
+        items = sorted(items, key=lambda item: item['updatedAt'])
+    stop = len(items) if before is None else int(before)
+    start = max(stop - 100, 0)
+    edges = []
+    for position, item in enumerate(items[start:stop], start):
+        comments = item['comments'][:100]
+        node = dict(item, comments={
+            'totalCount': len(item['comments']),
+            'pageInfo': {
+                'startCursor': 'c0' if comments else None,
+                'endCursor': 'c{}'.format(len(comments)) if comments else None,
+            },
+            'edges': [
+                {'cursor': 'c{}'.format(k + 1), 'node': node}
+                for k, node in enumerate(comments)],
+        })
+        edges.append({'cursor': str(position), 'node': node})
+    return {
+        'totalCount': len(items),
+        'pageInfo': {'startCursor': str(start), 'endCursor': str(stop - 1)},
+        'edges': edges,
+    }
+
+
+class StubServer:
+    """
+    Serves the repositories given by name ("owner/repo") on a local port. Each request is
+    recorded as its (Authorization header, query). The next requests are answered with the
+    (status, headers) of failures while there are some (normally for None), and all requests
+    sent with a key of keys with its (status, headers).
+    """
+
+    def __init__(self, repositories=None):
+        self.repositories = repositories if repositories is not None else {}
+        self.requests = []
+        self.failures = []
+        self.keys = {}
+        self.remaining = 5000
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['query']
+                status, headers, payload = stub.answer(query, self.headers['Authorization'])
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/graphql'.format(self.server.server_address[1])
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def answer(self, query, authorization):
+        with self.lock:
+            self.requests.append((authorization, query))
+            key = authorization.split(' ', 1)[-1] if authorization else None
+            if key in self.keys:
+                status, headers = self.keys[key]
+                return status, headers, {'message': 'HTTP error {}'.format(status)}
+            failure = self.failures.pop(0) if len(self.failures) > 0 else None
+            if failure is not None:
+                status, headers = failure
+                return status, headers, {'message': 'HTTP error {}'.format(status)}
+            self.remaining -= 1
+            remaining = self.remaining
+        reset = time.time() + 3600
+        rate_limit = {
+            'cost': 1,
+            'remaining': remaining,
+            'resetAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(reset)),
+        }
+        headers = {'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Reset': str(int(reset))}
+        if 'repository(' not in query:
+            return 200, headers, {'data': dict(self.threads(query), rateLimit=rate_limit)}
+
+        owner, name = re.search(r'repository\(owner:"([^"]*)", name:"([^"]*)"\)', query).groups()
+        repository = self.repositories.get('{}/{}'.format(owner, name))
+        if repository is None:
+            return 200, headers, {
+                'data': {'repository': None, 'rateLimit': rate_limit},
+                'errors': [{'message': 'Could not resolve to a Repository'}],
+            }
+        data = {'createdAt': '2020-01-01T00:00:00Z'}
+        for issue_type in ('pullRequests', 'issues'):
+            match = re.search(
+                issue_type + r'\(last:100 (?:before:"([^"]*)")? *orderBy: \{field: (\w+)', query)
+            if match is not None:
+                data[issue_type] = page(repository[issue_type], *match.groups())
+        return 200, headers, {'data': {'repository': data, 'rateLimit': rate_limit}}
+
+    def threads(self, query):
+        """
+        Returns the next comments of the threads of a query, by alias.
+        """
+        nodes = {
+            item['id']: item
+            for repository in self.repositories.values()
+            for items in repository.values() for item in items}
+        data = {}
+        for alias, node_id, cursor in re.findall(
+                r'(t\d+): node\(id:"([^"]*)"\)\{\s*\.\.\. on Issue\{\s*'
+                r'comments\(first:100 after:"c(\d+)"\)', query):
+            start = int(cursor)
+            comments = nodes[node_id]['comments'][start:start + 100]
+            data[alias] = {'comments': {
+                'pageInfo': {
+                    'endCursor': 'c{}'.format(start + len(comments)),
+                    'hasNextPage': start + len(comments) < len(nodes[node_id]['comments']),
+                },
+                'edges': [{'node': node} for node in comments],
+            }}
+        return data
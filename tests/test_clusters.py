@@ -0,0 +1,89 @@
+#  Property tests of the pattern clustering of bodegha.py
+#
+#  The patterns feature counts the connected components of the graph linking comments at
+#  distance at most eps (pair_components), which must be the clusters of
+#  DBSCAN(eps, min_samples=1, metric='precomputed'). Distances are drawn at random, including
+#  distances exactly at eps and just above it.
+#
+#  Usage: python -m pytest tests
+
+
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+
+cluster = pytest.importorskip('sklearn.cluster')
+
+EPS = bodegha.FEATURE_PARAMS['eps']
+
+
+def dbscan(matrix, eps=EPS):
+    return cluster.DBSCAN(eps=eps, min_samples=1, metric='precomputed').fit_predict(matrix)
+
+
+def random_matrix(random_state, n, kind):
+    if kind == 'uniform':
+        m = random_state.uniform(0, 1, (n, n))
+    elif kind == 'boundary':
+        m = random_state.choice(
+            [0.0, 0.25, np.nextafter(EPS, 0), EPS, np.nextafter(EPS, 1), 1.0], (n, n))
+    else:
+        points = random_state.uniform(0, 3, (n, 2))
+        m = np.sqrt(((points[:, np.newaxis] - points[np.newaxis]) ** 2).sum(axis=-1))
+    m = np.triu(m, 1)
+    return m + m.T
+
+
+@pytest.mark.parametrize('kind', ['uniform', 'boundary', 'points'])
+def test_pair_components_match_dbscan(kind):
+    random_state = np.random.RandomState(0)
+    for _ in range(300):
+        n = random_state.randint(1, 60)
+        m = random_matrix(random_state, n, kind)
+        rows, columns = np.nonzero(np.triu(m <= EPS, 1))
+        labels = bodegha.pair_components(n, rows, columns)
+        assert np.array_equal(labels, dbscan(m))
+
+
+def random_bodies(rnd, n):
+    # Few words, so that many distances are exactly eps.
+    words = ['fix', 'bug', 'lgtm', 'thanks', 'merge', 'test']
+    bodies = [' '.join(rnd.choice(words) for _ in range(rnd.randint(0, 5))) for _ in range(n)]
+    return bodegha.unique_items(bodies)
+
+
+def pairwise(bodies):
+    distance = bodegha.FEATURE_PARAMS['func']
+    m = np.zeros((len(bodies), len(bodies)))
+    for i in range(len(bodies)):
+        for j in range(i + 1, len(bodies)):
+            m[i, j] = m[j, i] = distance(bodies[i], bodies[j])
+    return m
+
+
+def test_account_features_match_dbscan():
+    rnd = random.Random(0)
+    for _ in range(200):
+        bodies, counts = random_bodies(rnd, rnd.randint(1, 80))
+        (patterns, _), _ = bodegha.account_features(bodies, counts, bodegha.FEATURE_PARAMS)
+        assert patterns == len(np.unique(dbscan(pairwise(bodies))))
+
+
+def test_incremental_account_features_match_dbscan():
+    rnd = random.Random(1)
+    for _ in range(200):
+        bodies, counts = random_bodies(rnd, rnd.randint(1, 60))
+        _, state = bodegha.account_features(bodies, counts, bodegha.FEATURE_PARAMS)
+        # Comments leave and enter the window.
+        kept = [body for body in bodies if rnd.random() < 0.8]
+        added, _ = random_bodies(rnd, rnd.randint(0, 10))
+        bodies, counts = bodegha.unique_items(added + kept)
+        (patterns, _), _ = bodegha.account_features(
+            bodies, counts, bodegha.FEATURE_PARAMS, state)
+        assert patterns == len(np.unique(dbscan(pairwise(bodies))))
@@ -0,0 +1,254 @@
+#  Tests of the download of comments of bodegha.py, against a local stub of the GitHub
+#  GraphQL API (see stub_graphql.py)
+#
+#  Usage: python -m pytest tests
+
+
+import collections
+import os
+import sys
+from datetime import datetime
+from urllib.error import HTTPError
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+from stub_graphql import expected_comments, make_repository, timestamp  # noqa: E402
+
+
+class Clock:
+    """
+    Clock of a RateLimiter whose sleeps are recorded and only advance the clock.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def fetch(repository, date, limiter, apikey='key', before=None):
+    """
+    Downloads the comments of repository created after date, as (author, body, number,
+    created_at, type) comments.
+    """
+    columns = bodegha.new_comment_columns()
+    downloaded = {'pullRequests': set(), 'issues': set()}
+    fetched = bodegha.fetch_comments(
+        repository, apikey, date, columns, downloaded, before=before, limiter=limiter)
+    assert fetched is not None
+    return list(zip(*(columns[column] for column in bodegha.COMMENT_COLUMNS[:5])))
+
+
+def expected_pages(repository, date):
+    """
+    Returns the number of pages requested to download the issues and pull requests of a
+    repository created after date: until a page has an older one, or all of them are
+    downloaded.
+    """
+    pages = 0
+    for items in repository.values():
+        newer = sum(1 for item in items if item['createdAt'] > timestamp(date))
+        pages += newer // 100 + 1 if newer < len(items) else max(-(-newer // 100), 1)
+    return pages
+
+
+def page_requests(stub):
+    return [query for _, query in stub.requests if 'repository(' in query]
+
+
+def thread_requests(stub):
+    return [query for _, query in stub.requests if 'repository(' not in query]
+
+
+def test_fetch_comments_pages_both_streams(stub):
+    repository = make_repository(pulls=250, issues=230)
+    stub.repositories['owner/repo'] = repository
+    clock = Clock()
+    date = datetime(2023, 1, 1)
+    comments = fetch('owner/repo', date, bodegha.RateLimiter(clock, clock.sleep))
+    assert collections.Counter(comments) == collections.Counter(
+        expected_comments(repository, date))
+    # Pull requests and issues are paged separately, 100 at a time.
+    assert len(page_requests(stub)) == 3 + 3 == expected_pages(repository, date)
+    assert thread_requests(stub) == []
+    assert clock.sleeps == []
+
+
+def test_fetch_comments_stops_at_date(stub):
+    repository = make_repository(pulls=250, issues=230)
+    stub.repositories['owner/repo'] = repository
+    date = datetime.strptime(repository['pullRequests'][120]['createdAt'], '%Y-%m-%dT%H:%M:%SZ')
+    comments = fetch('owner/repo', date, bodegha.RateLimiter())
+    assert collections.Counter(comments) == collections.Counter(
+        expected_comments(repository, date))
+    # 129 pull requests are newer than date: one page of them, then one with older ones.
+    assert len(page_requests(stub)) == expected_pages(repository, date)
+    assert len([query for query in page_requests(stub) if 'pullRequests(' in query]) == 2
+
+
+def test_fetch_comments_long_threads(stub):
+    repository = make_repository(pulls=120, issues=80, long_threads=0.3)
+    stub.repositories['owner/repo'] = repository
+    date = datetime(2023, 1, 1)
+    comments = fetch('owner/repo', date, bodegha.RateLimiter())
+    assert collections.Counter(comments) == collections.Counter(
+        expected_comments(repository, date))
+
+    # Each page of comments after the first one is requested once, THREADS_PER_QUERY
+    # threads at a time.
+    pages = sum(
+        (len(item['comments']) - 1) // 100
+        for items in repository.values() for item in items if len(item['comments']) > 100)
+    assert pages > bodegha.THREADS_PER_QUERY
+    aliases = [query.count(': node(id:') for query in thread_requests(stub)]
+    assert sum(aliases) == pages
+    assert max(aliases) == bodegha.THREADS_PER_QUERY
+
+
+def test_fetch_comments_unknown_repository(stub):
+    with pytest.raises(bodegha.BodeghaError, match='Could not resolve'):
+        fetch('owner/unknown', datetime(2023, 1, 1), bodegha.RateLimiter())
+
+
+def download(stub, clock):
+    stub.repositories['owner/repo'] = make_repository(pulls=10, issues=10)
+    return bodegha.download_comments(
+        'owner/repo', 'key', limiter=bodegha.RateLimiter(clock, clock.sleep))
+
+
+def test_backoff_retry_after(stub):
+    stub.failures = [(403, {'Retry-After': '7'})]
+    clock = Clock()
+    assert download(stub, clock) is not None
+    assert clock.sleeps == [7]
+    assert len(stub.requests) == 2
+
+
+def test_backoff_rate_limit_exhausted(stub):
+    clock = Clock()
+    stub.failures = [(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1030'})]
+    assert download(stub, clock) is not None
+    # Until the reset, and not more once it is reached.
+    assert clock.sleeps == [31]
+    assert len(stub.requests) == 2
+
+
+def test_backoff_server_errors(stub):
+    clock = Clock()
+    stub.failures = [(502, {}), (504, {})]
+    assert download(stub, clock) is not None
+    assert clock.sleeps == [1, 2]
+
+
+def test_backoff_client_error(stub):
+    clock = Clock()
+    stub.failures = [(500, {}), (400, {})]
+    with pytest.raises(HTTPError):
+        download(stub, clock)
+    assert clock.sleeps == []
+    assert len(stub.requests) == 1
+
+
+@pytest.mark.parametrize('headers', [
+    {'Retry-After': '60'},
+    {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1060'},
+    {},
+])
+def test_backoff_gives_up(stub, headers):
+    clock = Clock()
+    stub.failures = [(403 if headers else 502, headers)] * (bodegha.MAX_RETRIES + 5)
+    with pytest.raises(HTTPError):
+        download(stub, clock)
+    assert len(stub.requests) == bodegha.MAX_RETRIES + 1
+
+
+@pytest.mark.parametrize('headers', [
+    {'Retry-After': '86400'},
+    {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1000000'},
+])
+def test_backoff_waits_at_most_max_backoff(stub, headers):
+    clock = Clock()
+    stub.failures = [(403, headers)]
+    assert download(stub, clock) is not None
+    assert clock.sleeps == [bodegha.MAX_BACKOFF]
+
+
+def test_backoff_invalid_retry_after(stub):
+    clock = Clock()
+    stub.failures = [(403, {'Retry-After': 'soon'})]
+    with pytest.raises(HTTPError):
+        download(stub, clock)
+
+
+def test_rate_limit_is_respected(stub):
+    stub.repositories['owner/repo'] = make_repository(pulls=250, issues=0)
+    stub.remaining = 3
+    clock = Clock()
+    limiter = bodegha.RateLimiter(clock, clock.sleep)
+    reset = clock.now + 600
+    limiter.record({'cost': 1, 'remaining': 0, 'resetAt': timestamp(
+        datetime.utcfromtimestamp(reset))})
+    fetch('owner/repo', datetime(2023, 1, 1), limiter, before={'pullRequests': None})
+    # The first request waits for the reset, the others do not.
+    assert clock.sleeps == [601]
+    assert len(stub.requests) == 3
+
+
+def test_key_pool_routes_around_revoked_and_exhausted_keys(stub):
+    repository = make_repository(pulls=250, issues=230)
+    stub.repositories['owner/repo'] = repository
+    clock = Clock()
+    stub.keys = {
+        'revoked': (401, {}),
+        'exhausted': (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '4600'}),
+    }
+    pool = bodegha.KeyPool(['revoked', 'exhausted', 'valid'], clock, clock.sleep)
+    revoked = bodegha.METRICS.get('revoked_keys')
+    date = datetime(2023, 1, 1)
+    comments = fetch('owner/repo', date, pool, apikey=pool)
+    assert collections.Counter(comments) == collections.Counter(
+        expected_comments(repository, date))
+
+    keys = [authorization.split(' ')[1] for authorization, _ in stub.requests]
+    # Each failing key is tried once, without waiting, then the valid key is used.
+    assert keys.count('revoked') == 1
+    assert keys.count('exhausted') == 1
+    assert keys.count('valid') == expected_pages(repository, date)
+    assert clock.sleeps == []
+    assert pool.revoked == {'revoked'}
+    assert len(pool) == 2
+    assert bodegha.METRICS.get('revoked_keys') == revoked + 1
+
+
+def test_key_pool_waits_when_all_keys_are_exhausted(stub):
+    stub.repositories['owner/repo'] = make_repository(pulls=10, issues=0)
+    clock = Clock()
+    stub.failures = [
+        (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1300'}),
+        (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1100'}),
+    ]
+    pool = bodegha.KeyPool(['first', 'second'], clock, clock.sleep)
+    fetch('owner/repo', datetime(2023, 1, 1), pool, apikey=pool, before={'pullRequests': None})
+    # Until the first reset, then with the key that was reset.
+    assert clock.sleeps == [101]
+    assert [authorization.split(' ')[1] for authorization, _ in stub.requests] == [
+        'first', 'second', 'second']
+
+
+def test_key_pool_all_keys_revoked(stub):
+    stub.repositories['owner/repo'] = make_repository(pulls=10, issues=0)
+    stub.keys = {'first': (401, {}), 'second': (401, {})}
+    pool = bodegha.KeyPool(['first', 'second'])
+    with pytest.raises(HTTPError):
+        fetch('owner/repo', datetime(2023, 1, 1), pool, apikey=pool, before={'pullRequests': None})
+    assert len(pool) == 0
+    with pytest.raises(bodegha.BodeghaError, match='revoked'):
+        pool.acquire()
@@ -0,0 +1,89 @@
+#  Tests of the download journal of bodegha.py: a download interrupted by an error is
+#  resumed from its journal, without requesting the journaled pages again, and gives the same
+#  comments as an uninterrupted download.
+#
+#  Usage: python -m pytest tests
+
+
+import os
+import sys
+from datetime import datetime
+from urllib.error import HTTPError
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+from stub_graphql import make_repository  # noqa: E402
+
+
+DATE = datetime(2023, 1, 1)
+
+
+def normalize(comments):
+    return (
+        comments.astype({'author': object})
+        .sort_values(['number', 'type', 'created_at', 'body'], kind='stable')
+        .reset_index(drop=True))
+
+
+def journals(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith('journal-'))
+
+
+def download(stub, directory=None, cache_dir=None, resume=True, date=DATE):
+    journal = (directory, resume) if directory is not None else None
+    return bodegha.process_comments(
+        'owner/repo', [], date, 1, 20, 'key', cache_dir, journal=journal)
+
+
+@pytest.fixture
+def repository(stub):
+    repository = make_repository(pulls=450, issues=380, long_threads=0.05)
+    stub.repositories['owner/repo'] = repository
+    return repository
+
+
+@pytest.mark.parametrize('cached', [False, True])
+@pytest.mark.parametrize('successes', [1, 5, 9])
+def test_resume_skips_journaled_pages(stub, repository, tmp_path, cached, successes):
+    cache_dir = str(tmp_path / 'cache') if cached else None
+    expected = download(stub, cache_dir=str(tmp_path / 'expected') if cached else None)
+    total = len(stub.requests)
+    assert total > 10
+
+    # The download fails after some requests, and its journal is kept.
+    del stub.requests[:]
+    stub.failures = [None] * successes + [(500, {})]
+    with pytest.raises(HTTPError):
+        download(stub, str(tmp_path), cache_dir)
+    assert journals(tmp_path) == ['journal-owner_repo.jsonl']
+    journaled = len(stub.requests) - 1
+
+    # With the start date of the interrupted download.
+    del stub.requests[:]
+    comments = download(stub, str(tmp_path), cache_dir, date=datetime(2024, 3, 1))
+    assert len(stub.requests) <= total - journaled
+    assert normalize(comments).equals(normalize(expected))
+    assert journals(tmp_path) == []
+
+
+def test_resume_drops_partial_record(stub, repository, tmp_path):
+    expected = download(stub)
+    stub.failures = [None] * 4 + [(500, {})]
+    with pytest.raises(HTTPError):
+        download(stub, str(tmp_path))
+    # As if the process was killed while writing a record.
+    with open(str(tmp_path / 'journal-owner_repo.jsonl'), 'a') as file:
+        file.write('{"stream": "issues", "comm')
+    comments = download(stub, str(tmp_path))
+    assert normalize(comments).equals(normalize(expected))
+    assert journals(tmp_path) == []
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_journal_is_removed_unless_resumed(stub, repository, tmp_path, cached):
+    stub.failures = [None] * 3 + [(500, {})]
+    with pytest.raises(HTTPError):
+        download(stub, str(tmp_path), str(tmp_path / 'cache') if cached else None, resume=False)
+    assert journals(tmp_path) == []
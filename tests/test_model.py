@@ -0,0 +1,89 @@
+#  Tests of the array-backed model of bodegha.py (ForestModel, model.npz) against the pickled
+#  scikit-learn model it is exported from (model.json)
+#
+#  Usage: python -m pytest tests
+
+
+import os
+import pickle
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+
+pytest.importorskip('sklearn')
+
+# Warnings of scikit-learn about the pickled model and the installed pandas.
+pytestmark = [
+    pytest.mark.filterwarnings('ignore:X has feature names'),
+    pytest.mark.filterwarnings('ignore:is_sparse is deprecated:DeprecationWarning'),
+]
+
+
+@pytest.fixture(scope='module')
+def pickled():
+    with warnings.catch_warnings():
+        # The model was pickled with another version of scikit-learn.
+        warnings.simplefilter('ignore')
+        with open(bodegha.resource_filename('model.json'), 'rb') as file:
+            return pickle.load(file)
+
+
+@pytest.fixture(scope='module')
+def forest():
+    model = bodegha.get_model()
+    assert isinstance(model, bodegha.ForestModel)
+    return model
+
+
+def samples(forest, n=20000):
+    """
+    Returns random features, and features at, just below and just above each threshold.
+    """
+    random = np.random.RandomState(1)
+    X = np.column_stack([
+        random.randint(1, 200, n),
+        random.randint(0, 50, n),
+        random.randint(1, 200, n),
+        random.uniform(0, 1, n),
+    ]).astype(np.float64)
+    for i in range(X.shape[1]):
+        thresholds = forest.threshold[(forest.feature == i) & (forest.left != -1)]
+        values = np.concatenate([
+            thresholds, np.nextafter(thresholds, -np.inf), np.nextafter(thresholds, np.inf)])
+        X[:len(values), i] = values
+    return X
+
+
+def test_forest_model_matches_pickled_model(pickled, forest):
+    import pandas
+    X = samples(forest)
+    frame = pandas.DataFrame(X, columns=bodegha.FEATURES)
+    assert np.array_equal(forest.predict(X), pickled.predict(frame))
+    assert np.array_equal(forest.predict_proba(X), pickled.predict_proba(frame))
+
+
+def test_predictions_match_pickled_model(pickled, forest):
+    import pandas
+    features = pandas.DataFrame(samples(forest, 2000), columns=bodegha.FEATURES)
+    features.insert(0, 'account', ['account{}'.format(i) for i in range(len(features))])
+    assert bodegha.predict(forest, features)['prediction'].equals(
+        bodegha.predict(pickled, features)['prediction'])
+    for row in features[:200].itertuples(index=False):
+        assert bodegha.predict_account(forest, row[1:]) == \
+            bodegha.predict_account(pickled, row[1:])
+
+
+def test_export_model_gives_model_npz(tmp_path):
+    target = str(tmp_path / 'model.npz')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        bodegha.export_model(bodegha.resource_filename('model.json'), target, samples=10000)
+    with np.load(target) as exported, np.load(bodegha.resource_filename('model.npz')) as shipped:
+        assert sorted(exported.files) == sorted(shipped.files)
+        for name in shipped.files:
+            assert np.array_equal(exported[name], shipped[name])
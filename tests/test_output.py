@@ -0,0 +1,94 @@
+#  Tests of the output of bodegha.py, in each output type and mode (single repository, batch
+#  and organization-wide)
+#
+#  Usage: python -m pytest tests
+
+
+import json
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+from stub_graphql import make_repository  # noqa: E402
+
+
+DATE = datetime(2023, 1, 1)
+REPOSITORIES = ['owner/repo', 'owner/other', 'owner/empty']
+
+
+@pytest.fixture
+def repositories(stub):
+    stub.repositories['owner/repo'] = make_repository(pulls=60, issues=40, humans=8)
+    stub.repositories['owner/other'] = make_repository(seed=1, pulls=60, issues=40, humans=8)
+    stub.repositories['owner/empty'] = make_repository(pulls=0, issues=0)
+    return REPOSITORIES
+
+
+def outputs(repositories, accounts, verbose, min_comments, output_type):
+    """
+    Returns the outputs of each mode, as text, or the BodeghaError of a repository in batch
+    mode.
+    """
+    def text(result):
+        # The ndjson lines of a repository in batch mode are read before the next one.
+        return result if isinstance(result, (str, bodegha.BodeghaError)) else '\n'.join(result)
+
+    args = [accounts, [], DATE, verbose, min_comments, 100, 'key', output_type, True]
+    return [
+        text(bodegha.progress(repositories[0], *args)),
+        text(bodegha.progress_org(repositories, *args)),
+    ] + [text(result) for _, result in bodegha.progress_many(repositories, *args)]
+
+
+# Predicted and unknown accounts, an account without comments, and no predicted account.
+@pytest.mark.filterwarnings('error::FutureWarning')
+@pytest.mark.parametrize('accounts, min_comments', [
+    ([], 10),
+    (['ci-bot', 'user1', 'nobody'], 10),
+    (['ci-bot', 'nobody'], 100000),
+])
+@pytest.mark.parametrize('verbose', [False, True])
+@pytest.mark.parametrize('output_type', ['json', 'csv', 'ndjson'])
+def test_output_without_future_warnings(
+        stub, repositories, accounts, min_comments, verbose, output_type):
+    single, org, *many = outputs(repositories, accounts, verbose, min_comments, output_type)
+    assert isinstance(many[-1], bodegha.BodeghaError)
+    for result in [single, org] + many[:-1]:
+        assert 'ci-bot' in result
+        if 'nobody' in accounts:
+            assert 'Not found' in result
+
+
+def records(text):
+    """
+    Returns the records of json or ndjson output, in order of account, with the type of each
+    value.
+    """
+    if text.startswith('['):
+        objects = json.loads(text)
+    else:
+        objects = [json.loads(line) for line in text.splitlines()]
+    return sorted(
+        [(key, value, type(value).__name__) for key, value in record.items()]
+        for record in objects)
+
+
+@pytest.mark.parametrize('accounts, min_comments', [
+    ([], 10),
+    (['ci-bot', 'user1', 'nobody'], 10),
+])
+@pytest.mark.parametrize('verbose', [False, True])
+def test_json_and_ndjson_records_are_the_same(
+        stub, repositories, accounts, min_comments, verbose):
+    ndjson = outputs(repositories, accounts, verbose, min_comments, 'ndjson')
+    for mode, (result, expected) in enumerate(zip(
+            outputs(repositories, accounts, verbose, min_comments, 'json'), ndjson)):
+        if isinstance(expected, bodegha.BodeghaError):
+            continue
+        assert records(result) == records(expected)
+        # A json array in single-repository and org-wide modes, one record per line otherwise.
+        assert result.startswith('[') == (mode < 2)
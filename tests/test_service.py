@@ -0,0 +1,36 @@
+#  Tests of the prediction service of bodegha.py (PredictionService), against a local stub of
+#  the GitHub GraphQL API
+#
+#  Usage: python -m pytest tests
+
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+from stub_graphql import make_repository  # noqa: E402
+
+
+@pytest.fixture
+def service(stub, tmp_path):
+    stub.repositories['owner/repo'] = make_repository(pulls=150, issues=120)
+    stub.repositories['owner/other'] = make_repository(seed=1, pulls=150, issues=120)
+    service = bodegha.PredictionService('key', str(tmp_path), processes=1, concurrency=4)
+    yield service
+    service.close()
+
+
+def test_requests_for_a_repository_share_its_download(stub, service):
+    futures = [
+        service.submit(repository, start_date='2023-01-01', min_comments=min_comments)
+        for repository in ('owner/repo', 'owner/other') for min_comments in (1, 5, 10)]
+    results = [future.result() for future in futures]
+    assert all('ci-bot' in result for result in results)
+    # Four pages of each repository for the first request, then one page of pull requests
+    # and one of issues for each of the others.
+    assert len(stub.requests) == 2 * (4 + 2 * 2)
+    # The download locks are removed once no request uses them.
+    assert service.downloads == {}
@@ -0,0 +1,131 @@
+#  Tests of the comment store of bodegha.py (--cache-dir): the comments read from the store
+#  after an incremental update are the ones a full download gives.
+#
+#  Usage: python -m pytest tests
+
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+from stub_graphql import add_comment, add_issue, make_repository  # noqa: E402
+
+
+DATE = datetime(2023, 1, 1)
+
+
+def normalize(comments):
+    return (
+        comments.astype({'author': object})
+        .sort_values(['number', 'type', 'created_at', 'body'], kind='stable')
+        .reset_index(drop=True))
+
+
+def full_download(date=DATE):
+    columns = bodegha.new_comment_columns()
+    downloaded = {'pullRequests': set(), 'issues': set()}
+    assert bodegha.fetch_comments('owner/repo', 'key', date, columns, downloaded) is not None
+    return normalize(bodegha.build_comments_frame(columns))
+
+
+def cached_download(cache_dir, date=DATE, refresh=False):
+    return normalize(bodegha.process_cached_comments(
+        'owner/repo', date, 'key', str(cache_dir), refresh))
+
+
+def update(repository, seed):
+    """
+    Adds comments to some issues and pull requests, and new ones, after all existing ones.
+    """
+    import random
+    rnd = random.Random(seed)
+    now = datetime(2025, 1, 1) + timedelta(days=seed)
+    for issue_type in ('pullRequests', 'issues'):
+        for index in rnd.sample(range(len(repository[issue_type])), 15):
+            now += timedelta(minutes=5)
+            add_comment(
+                repository, issue_type, index, rnd.choice(['ci-bot', 'user1', None]),
+                'Build {} passed'.format(seed), now)
+        for _ in range(rnd.randint(1, 120)):
+            now += timedelta(minutes=5)
+            add_issue(repository, issue_type, 'user2', 'new issue {}'.format(seed), now)
+
+
+@pytest.fixture
+def repository(stub):
+    repository = make_repository(pulls=300, issues=260, long_threads=0.05)
+    stub.repositories['owner/repo'] = repository
+    return repository
+
+
+def test_refresh_matches_full_download(stub, repository, tmp_path):
+    assert cached_download(tmp_path).equals(full_download())
+    for seed in range(3):
+        update(repository, seed)
+        del stub.requests[:]
+        cached = cached_download(tmp_path)
+        # Only the issues and pull requests updated since the previous run are downloaded.
+        requests = len(stub.requests)
+        del stub.requests[:]
+        assert cached.equals(full_download())
+        assert requests < len(stub.requests)
+
+
+def test_refresh_without_update(stub, repository, tmp_path):
+    expected = cached_download(tmp_path)
+    del stub.requests[:]
+    assert cached_download(tmp_path).equals(expected)
+    # One page of each type, that has no issue updated since the previous run.
+    assert len(stub.requests) == 2
+
+
+def test_earlier_start_date_extends_the_stored_period(stub, repository, tmp_path):
+    later = datetime(2024, 2, 15)
+    assert cached_download(tmp_path, later).equals(full_download(later))
+    update(repository, 0)
+    assert cached_download(tmp_path).equals(full_download())
+    # Comments older than the given start date are stored, but not returned.
+    assert cached_download(tmp_path, later).equals(full_download(later))
+
+
+def test_forced_refresh_matches_full_download(stub, repository, tmp_path):
+    cached_download(tmp_path)
+    update(repository, 0)
+    del stub.requests[:]
+    cached = cached_download(tmp_path, refresh=True)
+    requests = len(stub.requests)
+    del stub.requests[:]
+    assert cached.equals(full_download())
+    assert requests == len(stub.requests)
+
+
+def test_account_index_analyses_accounts_with_new_comments(stub, tmp_path):
+    import json
+    repository = make_repository(pulls=100, issues=80)
+    stub.repositories['owner/repo'] = repository
+
+    def run():
+        hits = bodegha.METRICS.get('account_index_hits')
+        result = bodegha.progress(
+            'owner/repo', [], [], DATE, True, 10, 1000, 'key', 'json', False,
+            cache_dir=str(tmp_path), account_index=True)
+        records = {record['account']: record for record in json.loads(result)}
+        return records, bodegha.METRICS.get('account_index_hits') - hits
+
+    first, hits = run()
+    assert hits == 0
+    second, hits = run()
+    assert second == first
+    assert first['ci-bot']['prediction'] == 'Bot'
+    confident = hits
+    assert confident > 0
+
+    # The window of ci-bot changed: it is analysed again, with its new comment.
+    add_comment(repository, 'issues', 3, 'ci-bot', 'Build 1 passed', datetime(2025, 1, 1))
+    third, hits = run()
+    assert hits == confident - 1
+    assert third['ci-bot']['comments'] == first['ci-bot']['comments'] + 1
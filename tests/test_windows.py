@@ -0,0 +1,79 @@
+#  Tests of the per-author comment windows of bodegha.py (CommentWindows): the comments they
+#  keep during the download give the same selected comments, comment counts and predictions
+#  as the full download.
+#
+#  Usage: python -m pytest tests
+
+
+import os
+import random
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bodegha  # noqa: E402
+from stub_graphql import make_repository  # noqa: E402
+
+
+DATE = datetime(2023, 1, 1)
+
+
+def full_download(repository):
+    columns = bodegha.new_comment_columns()
+    downloaded = {'pullRequests': set(), 'issues': set()}
+    assert bodegha.fetch_comments(repository, 'key', DATE, columns, downloaded) is not None
+    return bodegha.build_comments_frame(columns)
+
+
+def selection(comments, min_comments, max_comments):
+    return (
+        bodegha.select_comments(comments, [], [], min_comments, max_comments)
+        [bodegha.COMMENT_COLUMNS].astype({'author': object}).reset_index(drop=True))
+
+
+def counts(comments):
+    return bodegha.count_comments(comments).rename_axis(None).sort_index().astype('int64')
+
+
+@pytest.mark.parametrize('min_comments, max_comments', [(1, 1), (3, 5), (10, 100), (5, 300)])
+def test_windows_match_full_download(stub, min_comments, max_comments):
+    stub.repositories['owner/repo'] = make_repository(
+        pulls=300, issues=250, humans=30, long_threads=0.05)
+    full = full_download('owner/repo')
+    windowed = bodegha.process_comments(
+        'owner/repo', [], DATE, min_comments, max_comments, 'key')
+    assert len(windowed) < len(full)
+    assert selection(windowed, min_comments, max_comments).equals(
+        selection(full, min_comments, max_comments))
+    assert counts(windowed).equals(counts(full))
+    for output_type in ('json', 'csv'):
+        assert bodegha.analyse(
+            windowed, [], [], True, min_comments, max_comments, output_type, True) == \
+            bodegha.analyse(full, [], [], True, min_comments, max_comments, output_type, True)
+
+
+def test_windows_keep_ties_in_order():
+    rnd = random.Random(0)
+    for _ in range(100):
+        size = rnd.randint(1, 6)
+        windows = bodegha.CommentWindows(size)
+        columns = bodegha.new_comment_columns()
+        full = bodegha.new_comment_columns()
+        for i in range(rnd.randint(1, 200)):
+            # Few distinct dates, so that many comments are created at the same time.
+            node = {
+                'author': {'login': rnd.choice(['a', 'b', 'c'])},
+                'body': str(i),
+                'createdAt': '2024-01-0{}T00:00:00Z'.format(rnd.randint(1, 3)),
+            }
+            bodegha.append_comment(columns, node, i, 'issues_comment')
+            bodegha.append_comment(full, node, i, 'issues_comment')
+            # Appended page by page.
+            if rnd.random() < 0.3:
+                windows.extend(columns)
+        windows.extend(columns)
+        full = bodegha.build_comments_frame(full)
+        assert selection(windows.frame(), 1, size).equals(selection(full, 1, size))
+        assert counts(windows.frame()).equals(counts(full))